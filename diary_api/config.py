@@ -6,6 +6,7 @@ with open(CONFIG_FILE, 'r') as file:
     config = json.load(file)
 
 GSOY_MEASUREMENTS = config['GSOY_MEASUREMENTS']
+ROLLUP_RESOLUTIONS = config['ROLLUP_RESOLUTIONS']
 METADATA_MEASUREMENT = config['METADATA_MEASUREMENT']
 
 DB_CONFIG_FILE = os.path.join(os.path.dirname(__file__), 'config/db_config.json')
@@ -16,6 +17,14 @@ PORT = config['PORT']
 TOKEN = os.environ.get('DB_ADMIN_TOKEN')
 ORG = os.environ.get('DB_INIT_ORG')
 BUCKET = os.environ.get('DB_INIT_BUCKET')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 20))  # Keep-alive connections of the shared client per worker
+DB_TIMEOUT_MS = int(os.environ.get('DB_TIMEOUT_MS', 30000))  # Timeout of a database request
+DB_RETRIES = int(os.environ.get('DB_RETRIES', 3))  # Retries of a request whose connection failed, like a stale one
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 2 ** 20))  # Response cache memory budget, 0 disables it
+CACHE_TTL_S = int(os.environ.get('CACHE_TTL_S', 24 * 3600))  # Lifetime of a cached response
+CACHE_CHECK_INTERVAL_S = int(os.environ.get('CACHE_CHECK_INTERVAL_S', 60))  # Interval of the checks for a new import
+COALESCE_TIMEOUT_S = float(os.environ.get('COALESCE_TIMEOUT_S', 60))  # Wait for the same query of another request
+COALESCE_DIR = os.environ.get('COALESCE_DIR')  # Shared by the workers of a host to coalesce their queries, or None
 
 ISO_MAPPING = {
     "AF": "Afghanistan",
@@ -1,6 +1,8 @@
 from flask import request
 from flask_restx import Api, Resource, fields
+from config import ROLLUP_RESOLUTIONS
 from influx.gsoy import fetch_data
+from influx.query import parse_date
 from logging_config import logger
 
 
@@ -18,7 +20,9 @@ def initialize_routes(api: Api):
     @gsoy_namespace.route('/data')
     class ClimateData(Resource):
         @gsoy_namespace.doc('fetch_climate_data',
-                            params={'country_iso': {'description': 'A country iso', 'type': 'string', 'default': 'US'},
+                            params={'country_iso': {'description': 'A country iso, or several comma separated '
+                                                                   'country isos',
+                                                    'type': 'string', 'default': 'US'},
                                     'measurement': {'description': 'A measurement name', 'type': 'string',
                                                     'default': 'Average_Temperature'},
                                     'date': {'description': 'A specific date (YYYY-MM-DD)', 'type': 'string',
@@ -26,8 +30,13 @@ def initialize_routes(api: Api):
                                     'start_date': {'description': 'Start date of a range (YYYY-MM-DD)',
                                                    'type': 'string', 'default': '2016-01-01'},
                                     'end_date': {'description': 'End date of a range (YYYY-MM-DD)', 'type': 'string',
-                                                 'default': '2022-12-31'}},
+                                                 'default': '2022-12-31'},
+                                    'resolution': {'description': 'The resolution of the data, "year" or the period of '
+                                                                  'a rollup, like "decade"',
+                                                   'type': 'string', 'enum': ['year'] + ROLLUP_RESOLUTIONS,
+                                                   'default': 'year'}},
                             responses={200: 'Climate data matching the specified conditions.',
+                                       400: 'The dates or the resolution are invalid.',
                                        404: 'No data found for the specified conditions.'},
                             return_model=gsoy_measurement)
         @gsoy_namespace.marshal_list_with(gsoy_measurement)
@@ -40,14 +49,24 @@ def initialize_routes(api: Api):
             date = request.args.get('date')
             start_date = request.args.get('start_date')
             end_date = request.args.get('end_date')
+            resolution = request.args.get('resolution', 'year')
 
             if date and (start_date or end_date):
                 return {"message": "You cannot set both 'date' and 'start_date'/'end_date' parameters."}, 400
+            # Aborting skips the marshalling of the response, which would drop the message
+            if resolution != 'year' and resolution not in ROLLUP_RESOLUTIONS:
+                gsoy_namespace.abort(400, f"The resolution must be one of: {', '.join(['year'] + ROLLUP_RESOLUTIONS)}.")
+            for value in (date, start_date, end_date):
+                try:
+                    if value:
+                        parse_date(value)
+                except ValueError:
+                    gsoy_namespace.abort(400, f"The date '{value}' is not a valid date (YYYY-MM-DD).")
 
             logger.info(
                 f'Fetching climate data for country iso: {country_iso}, measurement: {measurement}, date: {date}, '
-                f'start date: {start_date}, end date: {end_date}.')
-            data = fetch_data(country_iso, measurement, date, start_date, end_date)
+                f'start date: {start_date}, end date: {end_date}, resolution: {resolution}.')
+            data = fetch_data(country_iso, measurement, date, start_date, end_date, resolution=resolution)
             logger.info(f'Fetched {len(data) if data is not None else "0"} climate data records.')
 
             if data:
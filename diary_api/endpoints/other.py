@@ -1,7 +1,9 @@
 from flask_restx import Api, Resource
 
 from influx.other import fetch_country_list, fetch_latest_timestamp, fetch_earliest_timestamp, \
-    fetch_available_measurements, fetch_minimum_temperature, fetch_maximum_temperature
+    fetch_available_measurements, fetch_minimum_temperature, fetch_maximum_temperature, fetch_importer_status
+from influx.cache import response_cache
+from influx.client import check_health
 
 from logging_config import logger
 
@@ -123,3 +125,44 @@ def initialize_routes(api: Api):
                 return temperature, 200
             else:
                 return {"message": "No maximum temperature found for this measurement."}, 404
+
+    @other_namespace.route('/status')
+    class ImporterStatus(Resource):
+        @other_namespace.doc('get_importer_status',
+                             responses={200: 'The state of the importer and the figures of its last run.',
+                                        404: 'No importer status found.'})
+        def get(self):
+            """
+            Fetch the state of the GSOY importer and the figures of its last run
+            """
+            logger.info('Fetching importer status.')
+            status = fetch_importer_status()
+            logger.info('Fetched importer status.')
+            if status:
+                return status, 200
+            else:
+                return {"message": "No importer status found."}, 404
+
+    @other_namespace.route('/health')
+    class Health(Resource):
+        @other_namespace.doc('get_health',
+                             responses={200: 'The database is reachable.',
+                                        503: 'The database is not reachable.'})
+        def get(self):
+            """
+            Check whether the API can reach the database
+            """
+            if check_health():
+                return {"status": "pass"}, 200
+            else:
+                return {"status": "fail", "message": "The database is not reachable."}, 503
+
+    @other_namespace.route('/cache')
+    class CacheStats(Resource):
+        @other_namespace.doc('get_cache_stats',
+                             responses={200: 'The counters and the size of the response cache of the worker.'})
+        def get(self):
+            """
+            Fetch the hit, miss and eviction counters of the response cache of the worker that answers the request
+            """
+            return response_cache.stats(), 200
@@ -0,0 +1,235 @@
+import functools
+import inspect
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from config import CACHE_MAX_BYTES, CACHE_TTL_S, CACHE_CHECK_INTERVAL_S
+from influx.singleflight import SingleFlight
+from logging_config import logger
+
+
+class ResponseCache:
+    """
+    An in-process cache of the results of the fetch functions, shared by all threads of a worker process.
+
+    Entries are evicted in least recently used order once their estimated size exceeds the memory budget, and expire
+    after a time to live. The data only changes when the GSOY importer has written to the database, so all entries are
+    dropped when the 'last_run', 'archive' or 'data_version' of the importer metadata changes, which is checked at most
+    every check interval. The 'data_version' changes on the runs that rewrite data without a new 'last_run', like
+    selective repairs and snapshot restores.
+    Concurrent misses of the same key are collapsed into one fetch by a SingleFlight.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL_S, check_interval=CACHE_CHECK_INTERVAL_S):
+        """
+        :param int max_bytes: The memory budget of the entries, 0 to cache nothing.
+        :param float ttl: The seconds after which an entry expires.
+        :param float check_interval: The seconds between the checks of the importer metadata.
+        """
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (value, size, expiry), in least recently used order
+        self._bytes = 0
+        self._version = None
+        self._generation = 0  # Incremented by every clear(), so that results fetched before are not stored
+        self._next_check = 0
+        self.flights = SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get_or_fetch(self, key, fetch):
+        """
+        Get the cached result for a key, or fetch and cache it. A thread that misses while the same key is fetched waits
+        for that fetch instead of fetching again.
+        Results are returned as they are cached, so callers must not modify them.
+
+        :param tuple key: The normalized function and arguments.
+        :param fetch: The function that fetches the result on a miss.
+        :type fetch: Callable[[], object]
+        :return: The result.
+        :rtype: object
+        :raises TimeoutError: If the fetch of the same key by another request takes longer than the coalesce timeout.
+        """
+        self.check_version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                self._remove(key)
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+
+        # The leader of the flight caches the result, also if it read it from another worker
+        return self.flights.do(key, fetch, lambda value: self.put(key, value, generation))
+
+    def put(self, key, value, generation):
+        """
+        Cache a result, evicting the least recently used entries to stay within the memory budget.
+
+        :param tuple key: The normalized function and arguments.
+        :param object value: The result.
+        :param int generation: The generation of the cache when the result was fetched. The result is dropped if the
+         cache was cleared since, since it may have been fetched from the data of an earlier import.
+        :return: None
+        :rtype: None
+        """
+        size = estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if generation != self._generation:
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def check_version(self):
+        """
+        Clear the cache if the importer has imported new data since the last check. Only one thread checks at a time,
+        at most every check interval. If the importer metadata cannot be fetched, the cache is kept until the next
+        check.
+
+        :return: None
+        :rtype: None
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now < self._next_check:
+                return
+            self._next_check = now + self.check_interval
+
+        try:
+            version = importer_version()
+        except Exception as e:
+            logger.warning(f'Failed to check the importer metadata, keeping the response cache. {e}')
+            return
+
+        with self._lock:
+            if version == self._version:
+                return
+            if self._entries:
+                logger.info(f'The importer imported new data ({version}), clearing {len(self._entries)} cached '
+                            f'responses.')
+                self.invalidations += 1
+            self._clear()
+            self._version = version
+
+    def clear(self):
+        """
+        Drop all entries.
+
+        :return: None
+        :rtype: None
+        """
+        with self._lock:
+            self._clear()
+
+    def stats(self):
+        """
+        :return: The counters and the size of the cache of this worker process.
+        :rtype: dict
+        """
+        stats = self.flights.stats()
+        with self._lock:
+            return {
+                **stats,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'ttl_s': self.ttl,
+                'last_run': self._version[0] if self._version else None,
+                'data_version': self._version[2] if self._version else None,
+            }
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _clear(self):
+        self._entries.clear()
+        self._bytes = 0
+        self._generation += 1
+
+
+response_cache = ResponseCache()
+
+
+def importer_version():
+    """
+    Get the identity of the data imported by the GSOY importer.
+
+    :return: The 'last_run', 'archive' and 'data_version' of the importer metadata, or None if the importer has not run
+     yet.
+    :rtype: tuple or None
+    """
+    from influx.other import fetch_importer_status
+
+    status = fetch_importer_status()
+    return (status.get('last_run'), status.get('archive'), status.get('data_version')) if status else None
+
+
+def estimate_size(value):
+    """
+    Estimate the memory used by a result, counting the strings and numbers it shares with other results as its own.
+
+    :param object value: The result, made of dicts, lists, tuples and scalars.
+    :return: The estimated size in bytes.
+    :rtype: int
+    """
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(estimate_size(key) + estimate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(estimate_size(item) for item in value)
+    return size
+
+
+def cached(key=None):
+    """
+    Cache the results of a fetch function in the response cache.
+
+    :param key: A function that normalizes the arguments of the fetch function to a hashable key, so that equivalent
+     requests share an entry. By default, the key is the arguments by name, with their defaults.
+    :type key: Callable[..., tuple] or None
+    :return: The decorator.
+    :rtype: Callable
+    """
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if key is not None:
+                arguments = key(*args, **kwargs)
+            else:
+                bound = signature.bind(*args, **kwargs)
+                bound.apply_defaults()
+                arguments = tuple(bound.arguments.items())
+            return response_cache.get_or_fetch((function.__module__, function.__name__) + arguments,
+                                               lambda: function(*args, **kwargs))
+
+        wrapper.uncached = function
+        return wrapper
+
+    return decorator
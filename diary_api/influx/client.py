@@ -0,0 +1,103 @@
+import os
+import threading
+
+from influxdb_client import InfluxDBClient
+from urllib3 import Retry
+from urllib3.exceptions import ConnectTimeoutError, MaxRetryError, NewConnectionError, ProtocolError
+
+from config import HOST, PORT, ORG, TOKEN, DB_POOL_SIZE, DB_TIMEOUT_MS, DB_RETRIES
+from logging_config import logger
+
+_lock = threading.Lock()
+_client = None
+_query_api = None
+_pid = None
+
+# The errors of a connection that could not be made or was dropped, unlike a read timeout of a slow query
+CONNECTION_ERRORS = (NewConnectionError, ConnectTimeoutError, ProtocolError)
+
+
+def get_client():
+    """
+    Get the InfluxDB client shared by all threads of the worker process, creating it on first use.
+    The client keeps up to DB_POOL_SIZE connections alive, and retries requests whose connection failed, like a
+    keep-alive connection that the database closed. A worker forked from a process that already created the client
+    creates its own, since connections cannot be shared across processes.
+
+    :return: The shared client and its query API. Callers keep both, since another thread can reset the shared client
+     meanwhile.
+    :rtype: tuple[influxdb_client.InfluxDBClient, influxdb_client.QueryApi]
+    """
+    global _client, _query_api, _pid
+    with _lock:
+        if _client is None or _pid != os.getpid():
+            _client = InfluxDBClient(
+                url=f'http://{HOST}:{PORT}',
+                token=TOKEN,
+                org=ORG,
+                enable_gzip=True,
+                timeout=DB_TIMEOUT_MS,
+                connection_pool_maxsize=DB_POOL_SIZE,
+                # Queries are read-only, so the POST requests of the query API are safe to retry
+                retries=Retry(total=DB_RETRIES, backoff_factor=0.1, allowed_methods=None),
+            )
+            _query_api = _client.query_api()
+            _pid = os.getpid()
+            logger.info(f'Connected to DB "{HOST}:{PORT}" with a pool of {DB_POOL_SIZE} connections.')
+        return _client, _query_api
+
+
+def query(flux, params=None):
+    """
+    Run a Flux query on the shared client.
+    If the query fails on a connection error, the client is reset, so the next query connects again. Other errors,
+    like a read timeout of a slow query, are raised without resetting the client.
+
+    :param str flux: The Flux query.
+    :param params: The values of the 'params' record of the query, or None.
+    :type params: dict or None
+    :return: The result tables.
+    :rtype: influxdb_client.client.flux_table.TableList
+    """
+    client, query_api = get_client()
+    try:
+        return query_api.query(flux, params=params)
+    except (MaxRetryError, *CONNECTION_ERRORS) as e:
+        # The retries of a failed request end in a MaxRetryError, whose reason is the error of the last retry
+        if isinstance(e.reason if isinstance(e, MaxRetryError) else e, CONNECTION_ERRORS):
+            logger.warning(f'Query failed on a connection error, resetting the DB client. {e}')
+            reset(client)
+        raise
+
+
+def reset(client=None):
+    """
+    Drop the shared client, so that the next query creates a new one.
+    The client is not closed, since other threads may still be using it. It closes its connections once the last of
+    them has let go of it.
+
+    :param client: The client that failed, which is only dropped if it is still the shared client, so that a client
+     that another thread created meanwhile is kept. None to drop the shared client in any case.
+    :type client: influxdb_client.InfluxDBClient or None
+    :return: None
+    :rtype: None
+    """
+    global _client, _query_api
+    with _lock:
+        if client is None or _client is client:
+            _client, _query_api = None, None
+
+
+def check_health():
+    """
+    Check whether the database answers on the shared client, and reset the client if it does not.
+
+    :return: Whether the database is reachable.
+    :rtype: bool
+    """
+    client, _ = get_client()
+    if client.ping():
+        return True
+    logger.warning(f'DB "{HOST}:{PORT}" did not answer the health check, resetting the DB client.')
+    reset(client)
+    return False
@@ -1,15 +1,52 @@
-from config import BUCKET, GSOY_MEASUREMENTS, ISO_MAPPING
-from flask import g
+from config import GSOY_MEASUREMENTS, ISO_MAPPING, ROLLUP_RESOLUTIONS
+from influx.cache import cached
+from influx.query import FluxQuery, date_range
 from logging_config import logger
 
 
-def fetch_data(country_iso=None, measurement=None, date=None, start_date=None, end_date=None, decade_flag=False):
+def data_cache_key(country_iso=None, measurement=None, date=None, start_date=None, end_date=None, decade_flag=False,
+                   resolution='year'):
+    """
+    Normalize the arguments of fetch_data() to the key of its cached result, so that equivalent requests share it, like
+    the same countries in another order, or a date and a range of that one date.
+
+    :return: The countries, measurement, time range and resolution of the request.
+    :rtype: tuple
+    """
+    country_isos = country_iso.split(',') if isinstance(country_iso, str) else country_iso
+    try:
+        dates = date_range(date, start_date, end_date)
+    except ValueError:
+        # Rejected by fetch_data() without a query
+        dates = (date, start_date, end_date)
+    return (tuple(sorted(set(country_isos))) if country_isos is not None else None, measurement or None, dates,
+            'decade' if decade_flag else resolution)
+
+
+@cached(key=data_cache_key)
+def fetch_data(country_iso=None, measurement=None, date=None, start_date=None, end_date=None, decade_flag=False,
+               resolution='year'):
     """
     Fetch climate data for a specified country or all countries based on given conditions.
-    If decade_flag is set to True, data will be fetched for decades.
+    Data of a coarser resolution than years is read from the rollups materialized by the importer, which hold one point
+    per period, timestamped at the start of the period. If decade_flag is set to True, data will be fetched for
+    decades.
+    All measurements and countries of a request are fetched in a single query, which only reads the time range of the
+    request. A start_date or end_date alone bounds the range on one side. Results are cached until the next import.
+
+    :param country_iso: A country iso, several comma separated country isos or a list of them, or None for all
+     countries.
+    :type country_iso: str or list[str] or None
+    :param str resolution: 'year', or one of ROLLUP_RESOLUTIONS, like 'decade'.
     """
     records = []
 
+    if decade_flag:
+        resolution = 'decade'
+    if resolution != 'year' and resolution not in ROLLUP_RESOLUTIONS:
+        logger.error(f"Invalid resolution: {resolution}")
+        return None
+
     if measurement:
         if measurement not in GSOY_MEASUREMENTS:
             logger.error(f"Invalid measurement: {measurement}")
@@ -18,40 +55,42 @@ def fetch_data(country_iso=None, measurement=None, date=None, start_date=None, e
     else:
         measurement_names = GSOY_MEASUREMENTS
 
-    for measurement in measurement_names:
-        query = f'from(bucket: "{BUCKET}") |> range(start: 0) |> filter(fn: (r) => r["_measurement"] == "{measurement}")'
+    country_isos = country_iso.split(',') if isinstance(country_iso, str) else country_iso
+    if country_isos is not None:
+        invalid = [iso for iso in country_isos if iso not in ISO_MAPPING]
+        if invalid:
+            logger.error(f"Invalid country iso: {', '.join(invalid)}")
+            return None
 
-        if country_iso is not None:
-            query += f' |> filter(fn: (r) => r["country_iso"] == "{country_iso}")'
+    try:
+        start, stop = date_range(date, start_date, end_date)
+    except ValueError as e:
+        logger.error(f"Invalid date: {e}")
+        return None
 
-        if date:
-            query += f' |> filter(fn: (r) => r["_time"] >= time(v: "{date}T00:00:00Z") and r["_time"] <= time(v: "{date}T23:59:59Z"))'
-        elif start_date and end_date:
-            query += f' |> filter(fn: (r) => r["_time"] >= time(v: "{start_date}T00:00:00Z") and r["_time"] <= time(v: "{end_date}T23:59:59Z"))'
-
-        tables = g.query_api.query(query)
-
-        logger.info(f'Retrieved {len(tables)} tables for measurement: {measurement}')
-
-        for table in tables:
-            for record in table.records:
-                entry = {
-                    'measurement': measurement,
-                    'country_iso': record.values.get('country_iso'),
-                    'country_name': ISO_MAPPING[record.values.get('country_iso')],
-                    'value': record.get_value(),
-                    'time': record.get_time()
-                }
-                records.append(entry)
-
-        if not records:
-            if date:
-                logger.warning(f"No data found in DB for measurement: {measurement}, and date: {date}")
-            elif start_date and end_date:
-                logger.warning(
-                    f"No data found in DB for measurement: {measurement}, and range: {start_date} to {end_date}")
-            else:
-                logger.warning(f"No data found in DB for measurement: {measurement}")
+    # All measurements and countries are fetched in one query, and the records are mapped back by their series
+    series = {(name if resolution == 'year' else f'{name}_{resolution}'): name for name in measurement_names}
+    query = FluxQuery(start, stop).filter('_measurement', series).filter('_field', 'value')
+    if country_isos is not None:
+        query.filter('country_iso', country_isos)
+    tables = query.run()
+
+    logger.info(f'Retrieved {len(tables)} tables for {len(series)} measurements')
+
+    for table in tables:
+        for record in table.records:
+            entry = {
+                'measurement': series[record.get_measurement()],
+                'country_iso': record.values.get('country_iso'),
+                'country_name': ISO_MAPPING[record.values.get('country_iso')],
+                'value': record.get_value(),
+                'time': record.get_time()
+            }
+            records.append(entry)
+
+    # Keep the records in the order of the measurements, as if each measurement was fetched on its own
+    order = {name: index for index, name in enumerate(measurement_names)}
+    records.sort(key=lambda entry: order[entry['measurement']])
 
     if records:
         return records
@@ -63,3 +102,4 @@ def fetch_data(country_iso=None, measurement=None, date=None, start_date=None, e
         else:
             logger.warning(f"No data found in DB")
         return None
+
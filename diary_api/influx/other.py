@@ -1,7 +1,9 @@
-from config import BUCKET, GSOY_MEASUREMENTS
-from flask import g
+from config import GSOY_MEASUREMENTS, METADATA_MEASUREMENT
+from influx.cache import cached
+from influx.query import FluxQuery, schema_query
 
 
+@cached()
 def fetch_country_list():
     """
     Fetch the list of available countries.
@@ -9,8 +11,7 @@ def fetch_country_list():
     :return: A list of available countries.
     :rtype: list[str]
     """
-    query = f'import "influxdata/influxdb/schema" schema.tagValues(bucket: "{BUCKET}", tag: "country_iso", start: 1700-01-01T00:00:00Z)'
-    tables = g.query_api.query(query)
+    tables = schema_query('tagValues', tag='country_iso')
     countries = []
     for table in tables:
         for record in table.records:
@@ -18,6 +19,7 @@ def fetch_country_list():
     return countries
 
 
+@cached()
 def fetch_earliest_timestamp():
     """
     Fetch the earliest timestamp across all measurements.
@@ -26,17 +28,17 @@ def fetch_earliest_timestamp():
     :rtype: str or None
     """
     earliest_timestamp = None
-    for table in GSOY_MEASUREMENTS:
-        query = f'from(bucket: "{BUCKET}") |> range(start: 0) |> filter(fn: (r) => r["_measurement"] == "{table}") |> first(column: "_time")'
-        tables = g.query_api.query(query)
-        for table in tables:
-            for record in table.records:
-                timestamp = record.get_time()
-                if earliest_timestamp is None or timestamp < earliest_timestamp:
-                    earliest_timestamp = timestamp
+    tables = FluxQuery().filter('_measurement', GSOY_MEASUREMENTS).filter('_field', 'value') \
+        .then('first(column: "_time")').run()
+    for table in tables:
+        for record in table.records:
+            timestamp = record.get_time()
+            if earliest_timestamp is None or timestamp < earliest_timestamp:
+                earliest_timestamp = timestamp
     return earliest_timestamp.isoformat() if earliest_timestamp else None
 
 
+@cached()
 def fetch_latest_timestamp():
     """
     Fetch the latest timestamp across all measurements.
@@ -45,17 +47,17 @@ def fetch_latest_timestamp():
     :rtype: str or None
     """
     latest_timestamp = None
-    for table in GSOY_MEASUREMENTS:
-        query = f'from(bucket: "{BUCKET}") |> range(start: 0) |> filter(fn: (r) => r["_measurement"] == "{table}") |> last(column: "_time")'
-        tables = g.query_api.query(query)
-        for table in tables:
-            for record in table.records:
-                timestamp = record.get_time()
-                if latest_timestamp is None or timestamp > latest_timestamp:
-                    latest_timestamp = timestamp
+    tables = FluxQuery().filter('_measurement', GSOY_MEASUREMENTS).filter('_field', 'value') \
+        .then('last(column: "_time")').run()
+    for table in tables:
+        for record in table.records:
+            timestamp = record.get_time()
+            if latest_timestamp is None or timestamp > latest_timestamp:
+                latest_timestamp = timestamp
     return latest_timestamp.isoformat() if latest_timestamp else None
 
 
+@cached()
 def fetch_available_measurements(country_iso=None):
     """
     Fetch the available measurements for a specified country.
@@ -64,18 +66,15 @@ def fetch_available_measurements(country_iso=None):
     :return: A list of available measurements for the specified country or all countries.
     :rtype: list[str] or None
     """
-    available_measurements = []
-    for measurement in GSOY_MEASUREMENTS:
-        query = f'import "influxdata/influxdb/schema" schema.measurementTagValues(bucket: "{BUCKET}", measurement: "{measurement}", tag: "country_iso", start: 1700-01-01T00:00:00Z)'
-        if country_iso is not None:
-            query += f'|> filter(fn: (r) => r._value == "{country_iso}")'
-        tables = g.query_api.query(query)
-        for table in tables:
-            if len(table.records) > 0:
-                available_measurements.append(measurement)
+    # schema.measurements() takes no predicate, the measurements of a country are the values of its _measurement tag
+    tables = schema_query('tagValues', ('country_iso', country_iso) if country_iso is not None else None,
+                          tag='_measurement')
+    found = {record.get_value() for table in tables for record in table.records}
+    available_measurements = [measurement for measurement in GSOY_MEASUREMENTS if measurement in found]
     return available_measurements if available_measurements else None
 
 
+@cached()
 def fetch_maximum_temperature(measurement):
     """
     Fetch the maximum temperature for the specified measurement.
@@ -85,8 +84,8 @@ def fetch_maximum_temperature(measurement):
     :rtype: float or None
     """
     max_temp = None
-    query = f'from(bucket: "{BUCKET}") |> range(start: 0) |> filter(fn: (r) => r["_measurement"] == "{measurement}") |> max(column: "_value")'
-    tables = g.query_api.query(query)
+    tables = FluxQuery().filter('_measurement', measurement).filter('_field', 'value') \
+        .then('max(column: "_value")').run()
     for table in tables:
         for record in table.records:
             value = record.get_value()
@@ -95,6 +94,7 @@ def fetch_maximum_temperature(measurement):
     return max_temp
 
 
+@cached()
 def fetch_minimum_temperature(measurement):
     """
     Fetch the minimum temperature for the specified measurement.
@@ -104,11 +104,32 @@ def fetch_minimum_temperature(measurement):
     :rtype: float or None
     """
     min_temp = None
-    query = f'from(bucket: "{BUCKET}") |> range(start: 0) |> filter(fn: (r) => r["_measurement"] == "{measurement}") |> min(column: "_value")'
-    tables = g.query_api.query(query)
+    tables = FluxQuery().filter('_measurement', measurement).filter('_field', 'value') \
+        .then('min(column: "_value")').run()
     for table in tables:
         for record in table.records:
             value = record.get_value()
             if min_temp is None or value < min_temp:
                 min_temp = value
     return min_temp
+
+
+def fetch_importer_status():
+    """
+    Fetch the state of the GSOY importer and the figures of its last run, as recorded by the importer.
+    The state changes from 'running' to 'idle' once an import has finished, and the 'archive', 'last_run' and
+    'data_version' fields identify the written data, so clients can invalidate their caches when they change.
+    Not cached, since the response cache checks it to find new imports.
+
+    :return: The latest value of every field of the importer metadata, like 'run_state', 'last_run' and 'archive'.
+    :rtype: dict or None
+    """
+    tables = FluxQuery().filter('_measurement', METADATA_MEASUREMENT).filter('script', 'gsoy_importer') \
+        .then('last()').run()
+    status = {}
+    for table in tables:
+        for record in table.records:
+            # The figures of the shards of a sharded import are tagged with their shard
+            if record.values.get('shard') is None:
+                status[record.get_field()] = record.get_value()
+    return status if status else None
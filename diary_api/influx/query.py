@@ -0,0 +1,141 @@
+import re
+from datetime import datetime, timedelta, timezone
+
+from config import BUCKET
+from influx import client
+
+# The start of all queries without a start date. GSOY data begins before 1970, so range(start: 0) misses its oldest
+# years
+EARLIEST = datetime(1700, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_date(date_string):
+    """
+    Parse a date of a request.
+
+    :param str date_string: The date (YYYY-MM-DD).
+    :return: The start of the date in UTC.
+    :rtype: datetime.datetime
+    :raises ValueError: If the date is malformed.
+    """
+    return datetime.strptime(date_string, '%Y-%m-%d').replace(tzinfo=timezone.utc)
+
+
+def date_range(date=None, start_date=None, end_date=None):
+    """
+    Get the time range of a request for a date or a range of dates. The end date is included in the range.
+
+    :param date: A specific date (YYYY-MM-DD), or None.
+    :type date: str or None
+    :param start_date: The first date of a range (YYYY-MM-DD), or None to start at EARLIEST.
+    :type start_date: str or None
+    :param end_date: The last date of a range (YYYY-MM-DD), or None to end now.
+    :type end_date: str or None
+    :return: The start of the range, and its exclusive stop or None.
+    :rtype: tuple[datetime.datetime, datetime.datetime or None]
+    :raises ValueError: If a date is malformed.
+    """
+    if date:
+        start = parse_date(date)
+        return start, start + timedelta(days=1)
+    start = parse_date(start_date) if start_date else EARLIEST
+    stop = parse_date(end_date) + timedelta(days=1) if end_date else None
+    return start, stop
+
+
+class FluxQuery:
+    """
+    Builds a Flux query over the bucket, with the time range pushed into range(), so that InfluxDB only reads the
+    shards of that range.
+
+    Values are passed to InfluxDB as query parameters instead of being interpolated into the query, except for filters
+    that match several values, which are anchored regular expressions. A regular expression cannot be a parameter, so
+    the values of those filters are escaped, and must be checked against the known measurements or countries first.
+    """
+
+    def __init__(self, start=EARLIEST, stop=None):
+        """
+        :param datetime.datetime start: The start of the time range.
+        :param stop: The exclusive stop of the time range, or None to end now.
+        :type stop: datetime.datetime or None
+        """
+        self.params = {'bucket': BUCKET, 'start': start}
+        self._range = 'range(start: params.start)'
+        if stop is not None:
+            self.params['stop'] = stop
+            self._range = 'range(start: params.start, stop: params.stop)'
+        self._filters = []
+        self._operations = []
+
+    def filter(self, column, values):
+        """
+        Add a filter that matches a column against a value or several values. A regular expression over several values
+        is pushed down to the storage engine of InfluxDB like an equality.
+
+        :param str column: The column, like '_measurement'.
+        :param values: The value, or the values.
+        :type values: str or Iterable[str]
+        :return: The query.
+        :rtype: FluxQuery
+        """
+        values = [values] if isinstance(values, str) else list(values)
+        if len(values) == 1:
+            name = column.lstrip('_')
+            if name in self.params:
+                name = f'{name}_{len(self.params)}'
+            self.params[name] = values[0]
+            self._filters.append(f'r["{column}"] == params.{name}')
+        else:
+            self._filters.append(f'r["{column}"] =~ /^(?:{"|".join(re.escape(value) for value in values)})$/')
+        return self
+
+    def then(self, operation):
+        """
+        Add an operation after the filters, like 'first(column: "_time")'.
+
+        :param str operation: The Flux operation, without values of the request.
+        :return: The query.
+        :rtype: FluxQuery
+        """
+        self._operations.append(operation)
+        return self
+
+    def build(self):
+        """
+        :return: The Flux query.
+        :rtype: str
+        """
+        query = f'from(bucket: params.bucket) |> {self._range}'
+        if self._filters:
+            query += f' |> filter(fn: (r) => {" and ".join(self._filters)})'
+        for operation in self._operations:
+            query += f' |> {operation}'
+        return query
+
+    def run(self):
+        """
+        Run the query on the shared client.
+
+        :return: The result tables.
+        :rtype: influxdb_client.client.flux_table.TableList
+        """
+        return client.query(self.build(), self.params)
+
+
+def schema_query(function, predicate=None, **arguments):
+    """
+    Run a function of the Flux schema package over the bucket since EARLIEST, like schema.tagValues().
+
+    :param str function: The schema function, like 'tagValues'.
+    :param predicate: The tag and value that the series must have, or None for all series.
+    :type predicate: tuple[str, str] or None
+    :param arguments: The further arguments of the function, passed as query parameters, like tag='country_iso'.
+    :return: The result tables.
+    :rtype: influxdb_client.client.flux_table.TableList
+    """
+    params = {'bucket': BUCKET, 'start': EARLIEST, **arguments}
+    call = ', '.join(f'{name}: params.{name}' for name in params)
+    if predicate is not None:
+        tag, params['predicate_value'] = predicate
+        call += f', predicate: (r) => r["{tag}"] == params.predicate_value'
+    return client.query(f'import "influxdata/influxdb/schema" schema.{function}({call})', params)
@@ -0,0 +1,179 @@
+import hashlib
+import os
+import pickle
+import threading
+import time
+
+from config import COALESCE_TIMEOUT_S, COALESCE_DIR
+from logging_config import logger
+
+
+class Flight:
+    """
+    A fetch in progress, whose result or error is shared with the threads waiting for it.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Collapses identical concurrent fetches into one, so that a burst of the same request, like after a deploy or the
+    expiry of a cached response, runs a single query.
+
+    The first thread to fetch a key leads the flight and runs the fetch. The threads that fetch the same key meanwhile
+    wait for its result, and raise its error if it fails, or a TimeoutError if it takes longer than the timeout.
+    With a directory shared by the workers of a host, the leaders of several workers also take turns through a file
+    lock per key, and a leader that waited for another worker reads its result from a result file instead of fetching
+    again. The error of a worker is not shared, so the next worker fetches on its own. The lock file of a key is
+    removed when its flight ends, so the directory only holds the keys in flight and recent results.
+    """
+
+    def __init__(self, timeout=COALESCE_TIMEOUT_S, shared_dir=COALESCE_DIR):
+        """
+        :param float timeout: The seconds to wait for the fetch of another thread or worker.
+        :param shared_dir: The directory of the lock and result files shared by the workers of the host, or None to
+         only collapse the fetches of the threads of a worker.
+        :type shared_dir: str or None
+        """
+        self.timeout = timeout
+        self.shared_dir = shared_dir
+        self._lock = threading.Lock()
+        self._flights = {}
+        self.coalesced = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, fetch, store=None):
+        """
+        Fetch the result of a key, or wait for the fetch of the same key that is already in progress.
+
+        :param tuple key: The normalized function and arguments.
+        :param fetch: The function that fetches the result.
+        :type fetch: Callable[[], object]
+        :param store: A function that the leader passes the result to, whether it fetched the result or read it from
+         another worker, like to cache it.
+        :type store: Callable[[object], None] or None
+        :return: The result.
+        :rtype: object
+        :raises TimeoutError: If the fetch in progress takes longer than the timeout.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                with self._lock:
+                    self.timeouts += 1
+                raise TimeoutError(f'Timed out after {self.timeout}s waiting for the same query of another request.')
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = self._fetch_shared(key, fetch) if self.shared_dir else fetch()
+            if store is not None:
+                store(flight.result)
+            return flight.result
+        except BaseException as e:
+            # Also an error that is not an Exception, so that the waiters do not return None as the result
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def stats(self):
+        """
+        :return: The counters of the flights of this worker process.
+        :rtype: dict
+        """
+        with self._lock:
+            return {
+                'in_flight': len(self._flights),
+                'coalesced': self.coalesced,
+                'shared': self.shared,
+                'coalesce_timeouts': self.timeouts,
+            }
+
+    def _fetch_shared(self, key, fetch):
+        import fcntl
+
+        os.makedirs(self.shared_dir, exist_ok=True)
+        path = os.path.join(self.shared_dir, hashlib.sha1(repr(key).encode()).hexdigest())
+        started = time.time()
+        lock_file = self._lock_shared(f'{path}.lock', time.monotonic() + self.timeout)
+
+        try:
+            # A result written while this worker waited for the lock is the result of the same query
+            try:
+                if os.path.getmtime(f'{path}.result') >= started:
+                    with open(f'{path}.result', 'rb') as f:
+                        result = pickle.load(f)
+                    with self._lock:
+                        self.shared += 1
+                    return result
+            except FileNotFoundError:
+                pass
+
+            result = fetch()
+            with open(f'{path}.result.{os.getpid()}', 'wb') as f:
+                pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(f'{path}.result.{os.getpid()}', f'{path}.result')
+            self._remove_stale_results()
+            return result
+        finally:
+            # Removed while still locked, so workers that wait for the lock see that it is gone and lock a new file
+            os.remove(f'{path}.lock')
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    def _lock_shared(self, lock_path, deadline):
+        import fcntl
+
+        while True:
+            lock_file = open(lock_path, 'a')
+            # flock() cannot time out, so the lock is polled
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() > deadline:
+                        lock_file.close()
+                        with self._lock:
+                            self.timeouts += 1
+                        raise TimeoutError(f'Timed out after {self.timeout}s waiting for the same query of another '
+                                           f'worker.')
+                    time.sleep(0.01)
+
+            # The worker that held the lock removes the lock file when its flight ends, so the lock only counts if the
+            # file is still the one at the path
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino:
+                    return lock_file
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+
+    def _remove_stale_results(self):
+        # Results are only read by the workers that waited for them, so they are stale after the timeout
+        stale = time.time() - self.timeout
+        for entry in os.scandir(self.shared_dir):
+            try:
+                if entry.name.endswith('.result') and entry.stat().st_mtime < stale:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f'Failed to remove the stale coalesced result {entry.path}. {e}')
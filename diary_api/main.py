@@ -1,8 +1,6 @@
-from flask import Flask, g
+from flask import Flask
 from flask_restx import Api
-from influxdb_client import InfluxDBClient
 
-from config import HOST, PORT, ORG, TOKEN
 from endpoints.gsoy import initialize_routes as initialize_gsoy_routes
 from endpoints.other import initialize_routes as initialize_other_routes
 
@@ -16,25 +14,14 @@ def create_app():
         description='A simple API for fetching data from the Climate Diary database.',
     )
 
+    @api.errorhandler(TimeoutError)
+    def handle_timeout(error):
+        # Raised when a request waited too long for the same query of another request
+        return {"message": str(error)}, 503
+
     initialize_gsoy_routes(api)
     initialize_other_routes(api)
 
-    @app.before_request
-    def before_request():
-        g.db = InfluxDBClient(
-            url=f'http://{HOST}:{PORT}',
-            token=TOKEN,
-            org=ORG,
-            enable_gzip=True
-        )
-        g.query_api = g.db.query_api()
-
-    @app.teardown_appcontext
-    def close_db_client(error=None):
-        db = g.pop('db', None)
-        if db is not None:
-            db.close()
-
     return app
 
 
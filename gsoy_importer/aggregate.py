@@ -0,0 +1,250 @@
+import numpy as np
+
+from config import FIELD_MAPPING, FIPS_MAPPING, AGGREGATE_CHUNK_SIZE, ROLLUP_RESOLUTIONS
+
+# The measurement names and country ISO codes, indexed by the compact keys of the aggregation
+MEASUREMENTS = sorted({mapping.get('name', field_name) for field_name, mapping in FIELD_MAPPING.items()})
+COUNTRIES = sorted({country['country_iso'] for country in FIPS_MAPPING.values()})
+# The names of the written series, the measurements followed by the measurements of every rollup resolution, so that
+# rollup records index them like yearly records
+SERIES_MEASUREMENTS = MEASUREMENTS + [f'{measurement}_{resolution}' for resolution in ROLLUP_RESOLUTIONS
+                                      for measurement in MEASUREMENTS]
+MEASUREMENT_INDEX = {measurement: index for index, measurement in enumerate(MEASUREMENTS)}
+COUNTRY_INDEX = {country_iso: index for index, country_iso in enumerate(COUNTRIES)}
+
+YEAR_SPAN = 10000
+# Station values are summed as integers in millionths, far finer than the precision of the archive, so that the sums
+# are exact and the means do not depend on the order the values are added or the partial aggregates are merged in
+VALUE_SCALE = 10 ** 6
+
+RECORD_DTYPE = np.dtype([
+    ('country', '<u2'),
+    ('measurement', '<u2'),
+    ('year', '<i2'),
+    ('value', '<f8'),
+    ('min', '<f8'),
+    ('max', '<f8'),
+    ('station_count', '<i8'),
+])
+
+
+def encode_keys(country_index, measurement_indices, years):
+    """
+    Encodes (country, measurement, year) keys as integers that sort by country, then measurement, then year.
+
+    :param int country_index: The index of the country in COUNTRIES.
+    :param numpy.ndarray measurement_indices: The indices of the measurements in MEASUREMENTS.
+    :param numpy.ndarray years: The years.
+    :return: The keys.
+    :rtype: numpy.ndarray
+    """
+    return (np.int64(country_index) * len(MEASUREMENTS) + measurement_indices.astype(np.int64)) * YEAR_SPAN \
+        + years.astype(np.int64)
+
+
+def country_indices(fips_codes):
+    """
+    Gets the indices in COUNTRIES of the countries of FIPS codes.
+
+    :param fips_codes: The FIPS codes.
+    :type fips_codes: Iterable[str]
+    :return: The country indices.
+    :rtype: set[int]
+    """
+    return {COUNTRY_INDEX[FIPS_MAPPING[fips]['country_iso']] for fips in fips_codes if fips in FIPS_MAPPING}
+
+
+def country_fips(fips_codes):
+    """
+    Gets all FIPS codes of the countries of FIPS codes.
+    Several FIPS codes can map to the same ISO country, like MQ and UM, whose stations are aggregated together, so a
+    change of one of them is a change of all of them. FIPS codes that are not mapped are kept as they are.
+
+    :param fips_codes: The FIPS codes.
+    :type fips_codes: Iterable[str]
+    :return: The FIPS codes, along with the other FIPS codes of their countries.
+    :rtype: set[str]
+    """
+    fips_codes = set(fips_codes)
+    countries = {FIPS_MAPPING[fips]['country_iso'] for fips in fips_codes if fips in FIPS_MAPPING}
+    return fips_codes | {fips for fips, country in FIPS_MAPPING.items() if country['country_iso'] in countries}
+
+
+def series_order(records):
+    """
+    Orders records by InfluxDB series key, measurement then country_iso, and then by time.
+    Batches in this order touch few series each and append to them in time order, which is the cheapest shape for the
+    storage engine to index and compress. MEASUREMENTS and COUNTRIES are sorted, so their indices sort like the names.
+
+    :param numpy.ndarray records: The records, in RECORD_DTYPE.
+    :return: The indices that sort the records.
+    :rtype: numpy.ndarray
+    """
+    return np.lexsort((records['year'], records['country'], records['measurement']))
+
+
+def rollup_records(records, years=None):
+    """
+    Rolls yearly records up to the periods of ROLLUP_RESOLUTIONS, like decades.
+    A rollup record holds the mean, minimum, maximum and count of the station values of all years of its period, as if
+    the stations had been aggregated by period instead of by year. Its year is the first year of its period, and its
+    measurement indexes the rollup measurements in SERIES_MEASUREMENTS.
+
+    :param numpy.ndarray records: The yearly records, in RECORD_DTYPE, holding all years of their countries and
+     measurements.
+    :param years: The first and last year of the records, if they only hold some years. Only the periods within these
+     years are rolled up then, since the other periods miss years.
+    :type years: tuple[int, int] or None
+    :return: The rollup records, in RECORD_DTYPE.
+    :rtype: numpy.ndarray
+    """
+    if not len(records):
+        return np.empty(0, dtype=RECORD_DTYPE)
+    records = records[np.lexsort((records['year'], records['measurement'], records['country']))]
+    station_counts = records['station_count']
+    sums = records['value'] * station_counts
+
+    rollups = []
+    for offset, span in enumerate(ROLLUP_RESOLUTIONS.values(), start=1):
+        periods = records['year'] // span * span
+        keys = encode_keys(records['country'], records['measurement'], periods)
+        starts = np.flatnonzero(np.concatenate([[True], keys[1:] != keys[:-1]]))
+
+        rollup = np.empty(len(starts), dtype=RECORD_DTYPE)
+        rollup['country'] = records['country'][starts]
+        rollup['measurement'] = records['measurement'][starts] + offset * len(MEASUREMENTS)
+        rollup['year'] = periods[starts]
+        rollup['station_count'] = np.add.reduceat(station_counts, starts)
+        rollup['value'] = np.add.reduceat(sums, starts) / rollup['station_count']
+        rollup['min'] = np.minimum.reduceat(records['min'], starts)
+        rollup['max'] = np.maximum.reduceat(records['max'], starts)
+        if years is not None:
+            rollup = rollup[(rollup['year'] >= years[0]) & (rollup['year'] + span - 1 <= years[1])]
+        rollups.append(rollup)
+    return np.concatenate(rollups)
+
+
+class CountryAggregator:
+    """
+    Reduces the values of all stations of a country to one record per country, measurement and year, holding their
+    mean, minimum, maximum and station count.
+
+    Station values are buffered and reduced with vectorized group-by operations every AGGREGATE_CHUNK_SIZE values, and
+    the running sums, counts, minimums and maximums are merged with every reduction. Memory is therefore bounded by the
+    number of distinct keys, not by the number of station values. The sums are exact fixed-point integers in units of
+    1/VALUE_SCALE, so an aggregation yields the same means however its values are chunked, sharded and merged.
+    """
+
+    def __init__(self, chunk_size=AGGREGATE_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.num_values = 0
+        self._pending_keys = []
+        self._pending_values = []
+        self._pending_size = 0
+        self._keys = np.empty(0, dtype=np.int64)
+        self._sums = np.empty(0, dtype=np.int64)
+        self._counts = np.empty(0, dtype=np.int64)
+        self._mins = np.empty(0, dtype=np.float64)
+        self._maxs = np.empty(0, dtype=np.float64)
+
+    def add(self, country_iso, measurement_indices, years, values):
+        """
+        Adds the values of a station.
+
+        :param str country_iso: The country ISO code of the station.
+        :param numpy.ndarray measurement_indices: The indices of the measurements of the values in MEASUREMENTS.
+        :param numpy.ndarray years: The years of the values.
+        :param numpy.ndarray values: The values.
+        :return: None
+        :rtype: None
+        """
+        finite = np.isfinite(values)
+        if not finite.all():
+            measurement_indices, years, values = measurement_indices[finite], years[finite], values[finite]
+
+        self._pending_keys.append(encode_keys(COUNTRY_INDEX[country_iso], measurement_indices, years))
+        self._pending_values.append(values)
+        self._pending_size += len(values)
+        self.num_values += len(values)
+        if self._pending_size >= self.chunk_size:
+            self._reduce()
+
+    def records(self):
+        """
+        Gets the aggregated records, sorted by country, measurement and year.
+
+        :return: The records, in RECORD_DTYPE.
+        :rtype: numpy.ndarray
+        """
+        self._reduce()
+        records = np.empty(len(self._keys), dtype=RECORD_DTYPE)
+        series, records['year'] = np.divmod(self._keys, YEAR_SPAN)
+        records['country'], records['measurement'] = np.divmod(series, len(MEASUREMENTS))
+        records['value'] = self._sums / (self._counts * VALUE_SCALE)
+        records['min'] = self._mins
+        records['max'] = self._maxs
+        records['station_count'] = self._counts
+        return records
+
+    def state(self):
+        """
+        Gets the running state of the aggregation, to be restored with from_state().
+
+        :return: The keys, fixed-point sums, counts, minimums and maximums of the aggregation, and the number of values
+         added.
+        :rtype: dict[str, numpy.ndarray or int]
+        """
+        self._reduce()
+        return {'keys': self._keys, 'sums': self._sums, 'counts': self._counts, 'mins': self._mins, 'maxs': self._maxs,
+                'num_values': self.num_values}
+
+    @classmethod
+    def from_state(cls, state, chunk_size=AGGREGATE_CHUNK_SIZE):
+        """
+        Restores an aggregation from its running state.
+
+        :param dict state: The state returned by state().
+        :param int chunk_size: The number of values buffered between reductions.
+        :return: The restored aggregator.
+        :rtype: CountryAggregator
+        """
+        aggregator = cls(chunk_size)
+        sums = state['sums']
+        if sums.dtype.kind == 'f':
+            # The floating point sums of a state saved before the sums were fixed-point
+            sums = np.rint(sums * VALUE_SCALE).astype(np.int64)
+        aggregator._combine(state['keys'], sums, state['counts'], state['mins'], state['maxs'])
+        aggregator.num_values = int(state['num_values'])
+        return aggregator
+
+    def merge(self, other):
+        """
+        Merges the aggregation of other station values, like the partial aggregate of another shard.
+
+        :param CountryAggregator other: The aggregation to merge.
+        :return: None
+        :rtype: None
+        """
+        other._reduce()
+        self._combine(other._keys, other._sums, other._counts, other._mins, other._maxs)
+        self.num_values += other.num_values
+
+    def _reduce(self):
+        if not self._pending_keys:
+            return
+        keys = np.concatenate(self._pending_keys)
+        values = np.concatenate(self._pending_values)
+        self._pending_keys, self._pending_values, self._pending_size = [], [], 0
+        sums = np.rint(values * VALUE_SCALE).astype(np.int64)
+        self._combine(keys, sums, np.ones(len(keys), dtype=np.int64), values, values)
+
+    def _combine(self, keys, sums, counts, mins, maxs):
+        if not len(keys):
+            return
+        keys = np.concatenate([self._keys, keys])
+        order = np.argsort(keys, kind='stable')
+        self._keys, starts = np.unique(keys[order], return_index=True)
+        self._sums = np.add.reduceat(np.concatenate([self._sums, sums])[order], starts)
+        self._counts = np.add.reduceat(np.concatenate([self._counts, counts])[order], starts)
+        self._mins = np.minimum.reduceat(np.concatenate([self._mins, mins])[order], starts)
+        self._maxs = np.maximum.reduceat(np.concatenate([self._maxs, maxs])[order], starts)
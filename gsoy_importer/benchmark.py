@@ -0,0 +1,219 @@
+import argparse
+import csv
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from aggregate import MEASUREMENTS, COUNTRIES, series_order
+from config import FIELD_MAPPING
+from lineprotocol import LineProtocolEncoder
+from parsing import build_column_plan, read_values
+from synthetic import station_csv, synthetic_archive, synthetic_records
+
+
+def legacy_read_values(csv_reader, headers):
+    """
+    Reads the mapped values of a station file with the per-cell header lookups the importer used before the column
+    plan. Kept as the baseline of the parse benchmark.
+
+    :param csv_reader: The CSV reader of the station file, positioned after the header.
+    :param list[str] headers: The header row of the station file.
+    :return: A generator of (measurement name, time, value) tuples for the non-empty mapped cells.
+    :rtype: Iterator[tuple[str, str, float]]
+    """
+    for row in csv_reader:
+        time = f'{row[1]}-01-01T00:00:00.000Z'
+        for i, field_value in enumerate(row):
+            field_name = headers[i]
+            if field_name not in FIELD_MAPPING:
+                continue
+
+            human_readable_name = FIELD_MAPPING.get(field_name, {}).get('name', field_name)
+            value = row[headers.index(field_name)]
+            if value == '':
+                continue
+            yield human_readable_name, time, float(row[headers.index(field_name)])
+
+
+def _time_reader(text, read, repeat):
+    best = None
+    for _ in range(repeat):
+        csv_reader = csv.reader(io.StringIO(text, newline=''))
+        headers = next(csv_reader)
+        start = time.perf_counter()
+        num_values = sum(1 for _ in read(csv_reader, headers))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, num_values
+
+
+def benchmark_parse(args):
+    """
+    Compares the rows per second of the legacy per-cell loop and the column plan on a wide synthetic station file.
+
+    :param argparse.Namespace args: The parsed command line arguments.
+    :return: None
+    :rtype: None
+    """
+    text = station_csv('US000BENCH', first_year=1000, num_years=args.rows, empty_ratio=args.empty_ratio).decode()
+    num_columns = len(next(csv.reader(io.StringIO(text, newline=''))))
+    print(f'Synthetic station file: {args.rows} rows x {num_columns} columns, {len(text)} bytes')
+
+    readers = {
+        'legacy': legacy_read_values,
+        'column plan': lambda csv_reader, headers: read_values(csv_reader, build_column_plan(headers)),
+    }
+    rows_per_second = {}
+    for name, read in readers.items():
+        elapsed, num_values = _time_reader(text, read, args.repeat)
+        rows_per_second[name] = args.rows / elapsed
+        print(f'{name:>12}: {rows_per_second[name]:12,.0f} rows/s  ({num_values} values in {elapsed:.3f}s)')
+    print(f'     speedup: {rows_per_second["column plan"] / rows_per_second["legacy"]:.1f}x')
+
+
+def _encode_batches(records, batch_size):
+    encoder = LineProtocolEncoder(batch_size)
+    batches = []
+    for country, measurement, year, value, minimum, maximum, station_count in zip(
+            records['country'].tolist(), records['measurement'].tolist(), records['year'].tolist(),
+            records['value'].tolist(), records['min'].tolist(), records['max'].tolist(),
+            records['station_count'].tolist()):
+        batch = encoder.add(MEASUREMENTS[measurement], COUNTRIES[country], year, value, minimum, maximum, station_count)
+        if batch is not None:
+            batches.append(batch)
+    batch = encoder.flush()
+    if batch is not None:
+        batches.append(batch)
+    return batches
+
+
+def benchmark_write_order(args):
+    """
+    Compares the points per second that the database ingests in station order, the order of the rows and columns of
+    the station files, and in series order, as the importer writes them.
+    Every order is written to a scratch bucket of its own, which is deleted afterwards, so that no order writes into
+    series created by another.
+
+    :param argparse.Namespace args: The parsed command line arguments.
+    :return: None
+    :rtype: None
+    """
+    from influxdb_client import WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    from config import ORG
+    from influx import client, wait_for_db
+
+    wait_for_db()
+    records = synthetic_records(args.countries, num_years=args.years)
+    orders = {
+        'station order': records,
+        'series order': records[series_order(records)],
+    }
+    print(f'Synthetic records: {len(records)} points, {args.countries} countries x {len(MEASUREMENTS)} measurements x '
+          f'{args.years} years, batches of {args.batch_size} points')
+
+    points_per_second = {}
+    for name, ordered in orders.items():
+        batches = _encode_batches(ordered, args.batch_size)
+        bucket = client.buckets_api().create_bucket(bucket_name=f'gsoy_benchmark_{time.time_ns()}', org=ORG)
+        try:
+            with client.write_api(write_options=SYNCHRONOUS) as write_api:
+                start = time.perf_counter()
+                for batch in batches:
+                    write_api.write(bucket=bucket.name, record=batch, write_precision=WritePrecision.MS)
+                elapsed = time.perf_counter() - start
+        finally:
+            client.buckets_api().delete_bucket(bucket)
+        points_per_second[name] = len(ordered) / elapsed
+        series_per_batch = np.mean([len({line.partition(b' ')[0] for line in batch.splitlines()}) for batch in batches])
+        print(f'{name:>13}: {points_per_second[name]:10,.0f} points/s  ({elapsed:.2f}s, '
+              f'{series_per_batch:.0f} series per batch)')
+    print(f'      speedup: {points_per_second["series order"] / points_per_second["station order"]:.2f}x')
+
+
+def benchmark_import(args):
+    """
+    Runs import_data() end to end on a synthetic archive, with a sink in place of the database, and reports the rows
+    and points per second, the peak RSS and the time of every stage.
+    The run works in a scratch directory, so it uses none of the state of real runs. With --fail-below, it exits with
+    an error if fewer rows per second are parsed, as a regression gate for changes to the importer.
+
+    :param argparse.Namespace args: The parsed command line arguments.
+    :return: None
+    :rtype: None
+    """
+    from config import ARCHIVE_FILE_PATH, SNAPSHOT_FILE_PATH
+    from importer import import_data
+    from sinks import NullSink, MemorySink
+
+    with tempfile.TemporaryDirectory(prefix='gsoy_benchmark_') as work_dir:
+        cwd = os.getcwd()
+        os.chdir(work_dir)
+        try:
+            os.makedirs(os.path.dirname(ARCHIVE_FILE_PATH), exist_ok=True)
+            num_rows = synthetic_archive(ARCHIVE_FILE_PATH, args.stations, num_years=args.years,
+                                         empty_ratio=args.empty_ratio, num_countries=args.countries)
+            print(f'Synthetic archive: {args.stations} stations x {args.years} years, '
+                  f'{os.path.getsize(ARCHIVE_FILE_PATH) / 2 ** 20:.1f} MiB')
+
+            sink = MemorySink() if args.sink == 'memory' else NullSink()
+            summary = import_data(sink=sink, offline=True, snapshot_path=SNAPSHOT_FILE_PATH if args.snapshot else None)
+        finally:
+            os.chdir(cwd)
+
+    duration = summary['duration_s']
+    print(f'        rows: {num_rows / duration:12,.0f} rows/s  ({num_rows} rows in {duration:.2f}s)')
+    print(f'      values: {summary["values"] / duration:12,.0f} values/s')
+    print(f'      points: {summary["points"] / duration:12,.0f} points/s  ({sink.written_points} points in the sink)')
+    print(f'    peak RSS: {summary["peak_rss_bytes"] / 2 ** 20:.1f} MiB (importer), '
+          f'{summary["peak_worker_rss_bytes"] / 2 ** 20:.1f} MiB (largest parse worker)')
+    for name, seconds in summary['stage_times_s'].items():
+        print(f'{name:>12}: {seconds:.2f}s')
+    for name, telemetry in summary['telemetry'].items():
+        amounts = ', '.join(f'{amount} {unit}' for unit, amount in telemetry.items() if unit != 'seconds')
+        print(f'{name:>14}: {telemetry["seconds"]:.2f}s  ({amounts or "nothing"})')
+
+    if args.fail_below is not None and num_rows / duration < args.fail_below:
+        print(f'Regression: {num_rows / duration:,.0f} rows/s is below {args.fail_below:,.0f} rows/s')
+        sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the GSOY importer.')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    parse_parser = subparsers.add_parser('parse', help='Row projection of a wide station file.')
+    parse_parser.add_argument('--rows', type=int, default=20000, help='Rows of the synthetic station file.')
+    parse_parser.add_argument('--empty-ratio', type=float, default=0.3, help='Share of empty element cells.')
+    parse_parser.add_argument('--repeat', type=int, default=3, help='Runs per reader, the best one is reported.')
+    parse_parser.set_defaults(run=benchmark_parse)
+
+    write_order_parser = subparsers.add_parser('write-order', help='Write throughput of station and series order, '
+                                                                   'against the database of config/db_config.json.')
+    write_order_parser.add_argument('--countries', type=int, default=100, help='Countries of the synthetic records.')
+    write_order_parser.add_argument('--years', type=int, default=120, help='Years of the synthetic records.')
+    write_order_parser.add_argument('--batch-size', type=int, default=5000, help='Points per write request.')
+    write_order_parser.set_defaults(run=benchmark_write_order)
+
+    import_parser = subparsers.add_parser('import', help='End to end import of a synthetic archive into a sink.')
+    import_parser.add_argument('--stations', type=int, default=200, help='Station files of the synthetic archive.')
+    import_parser.add_argument('--years', type=int, default=120, help='Yearly rows of every station file.')
+    import_parser.add_argument('--countries', type=int, default=50, help='Countries the stations are spread over.')
+    import_parser.add_argument('--empty-ratio', type=float, default=0.3, help='Share of empty element cells.')
+    import_parser.add_argument('--sink', choices=('null', 'memory'), default='null',
+                               help='Discard the points, or keep them in memory.')
+    import_parser.add_argument('--snapshot', action='store_true', help='Also save the aggregates to a snapshot file.')
+    import_parser.add_argument('--fail-below', type=float, help='Exit with an error below this many rows/s.')
+    import_parser.set_defaults(run=benchmark_import)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
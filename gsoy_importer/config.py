@@ -12,7 +12,33 @@ BUCKET = os.environ.get('DB_INIT_BUCKET')
 
 GSOY_DATA_DIR = 'gsoy_data'
 LAST_RUN_LAST_RUN_FILE_PATH = 'last_run/last_run.txt'
-GSOY_DOWNLOAD_URL = "https://www.ncei.noaa.gov/data/gsoy/archive/gsoy-latest.tar.gz"
+MANIFEST_FILE_PATH = 'last_run/manifest.json'  # The station files imported by the last run
+FINGERPRINTS_FILE_PATH = 'last_run/fingerprints.npy'  # The (country, measurement, year) values in the database
+RUN_REPORT_FILE_PATH = 'last_run/run_report.json'  # The figures of the last run
+JOURNAL_FILE_PATH = 'last_run/journal.bin'  # The progress of an unfinished run, resumed by the next run
+SELECTIVE_JOURNAL_FILE_PATH = 'last_run/journal-selective.bin'  # The progress of an unfinished selective run
+JOURNAL_COMPACT_INTERVAL = 1000  # Station files journaled between compactions of the journal into a snapshot
+JOURNAL_WRITE_INTERVAL = 50000  # Points written between the journal records of the write progress
+SHARD_DIR = os.environ.get('GSOY_SHARD_DIR', 'last_run/shards')  # Shared by the nodes of a sharded import
+ARCHIVE_FILE_PATH = os.path.join(GSOY_DATA_DIR, 'gsoy-latest.tar.gz')
+GSOY_DOWNLOAD_URL = os.environ.get('GSOY_DOWNLOAD_URL', "https://www.ncei.noaa.gov/data/gsoy/archive/"
+                                                        "gsoy-latest.tar.gz")
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024  # Bytes read from the HTTP response at a time
+DOWNLOAD_QUEUE_SIZE = 64  # Downloaded chunks buffered ahead of the tar decoder
+BATCH_SIZE = 2000  # Points per encoded batch, and the initial points per write request
+ROLLUP_RESOLUTIONS = {'decade': 10, '5year': 5}  # Years per period of the rollups, written as <measurement>_<name>
+AGGREGATE_CHUNK_SIZE = 1000000  # Station values buffered between the vectorized reductions of the aggregation
+WRITE_MAX_IN_FLIGHT = 4  # Concurrent write requests
+WRITE_RETRIES = 5  # Attempts per write request before it is spooled
+WRITE_RETRY_DELAY_S = 1  # Delay before the first retry, doubled on every further retry
+WRITE_TARGET_LATENCY_S = 2  # Write latency the batch size adapts to
+MIN_BATCH_SIZE = 250
+MAX_BATCH_SIZE = 20000
+SPOOL_DIR = os.path.join(GSOY_DATA_DIR, 'spool')  # Batches that could not be written, replayed on the next run
+REJECTED_DIR = os.path.join(GSOY_DATA_DIR, 'rejected')  # Batches the database rejected, kept for inspection only
+SCHEDULER_POLL_INTERVAL_S = int(os.environ.get('GSOY_POLL_INTERVAL_S', 6 * 3600))  # Between checks for a new archive
+SNAPSHOT_FILE_PATH = os.path.join(GSOY_DATA_DIR, 'gsoy-aggregates.npz')  # The columnar snapshot of all aggregates
+MEMORY_SAMPLE_INTERVAL_S = 0.2  # Between the samples of the RSS of the importer and its workers during a run
 
 
 FIELD_MAPPING = {
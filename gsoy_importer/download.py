@@ -0,0 +1,365 @@
+import io
+import json
+import os
+import queue
+import threading
+import time
+import urllib.error
+import urllib.request
+import zlib
+from email.utils import formatdate
+
+from config import GSOY_DATA_DIR, ARCHIVE_FILE_PATH, GSOY_DOWNLOAD_URL, DOWNLOAD_CHUNK_SIZE, DOWNLOAD_QUEUE_SIZE
+from logging_config import logger
+
+
+class DownloadVerificationError(IOError):
+    """
+    Raised when a completed download is larger than the size announced by the server.
+    """
+
+
+class DownloadStream(io.RawIOBase):
+    """
+    A readable stream over an HTTP download that is still in progress.
+
+    A background thread reads the response body in chunks, appends them to a '.part' file and hands them to the reader
+    through a bounded queue, so decompression and parsing run while the download continues. A resumed download first
+    hands over the bytes already in the '.part' file and then appends the remainder of the response to it.
+    Once the download completes, its size is checked against the size announced by the server and the gzip CRC of the
+    whole file is verified, and only then is the '.part' file renamed to the target file name. A download that fails the
+    verification is removed and raises an error at the end of the stream, so a run never finishes on a corrupt archive.
+    The time the download took and the time the reader waited for it are kept in download_s and wait_s.
+    """
+
+    def __init__(self, response, file_name, resume_from=0, expected_size=None):
+        super().__init__()
+        self.bytes_downloaded = 0
+        self.download_s = 0.0
+        self.wait_s = 0.0
+        self._response = response
+        self._resume_from = resume_from
+        self._expected_size = expected_size
+        self._queue = queue.Queue(maxsize=DOWNLOAD_QUEUE_SIZE)
+        self._stopped = threading.Event()
+        self._chunk = memoryview(b'')
+        self._eof = False
+        self._thread = threading.Thread(target=self._download, args=(file_name,), daemon=True)
+        self._thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self._eof:
+            return 0
+        if not self._chunk:
+            start = time.perf_counter()
+            item = self._queue.get()
+            self.wait_s += time.perf_counter() - start
+            if item is None:
+                self._eof = True
+                return 0
+            if isinstance(item, Exception):
+                raise item
+            self._chunk = memoryview(item)
+
+        size = min(len(buffer), len(self._chunk))
+        buffer[:size] = self._chunk[:size]
+        self._chunk = self._chunk[size:]
+        return size
+
+    def close(self):
+        self._stopped.set()
+        super().close()
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def _finish(self, item, start):
+        self.download_s = time.perf_counter() - start
+        self._put(item)
+
+    def _download(self, file_name):
+        start = time.perf_counter()
+        part_file_name = f'{file_name}.part'
+        verifier = GzipVerifier()
+        try:
+            if self._resume_from:
+                with open(part_file_name, 'rb') as part_file:
+                    remaining = self._resume_from
+                    while remaining and not self._stopped.is_set():
+                        chunk = part_file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                        remaining -= len(chunk)
+                        verifier.update(chunk)
+                        self._put(chunk)
+
+            with self._response as response, open(part_file_name, 'ab' if self._resume_from else 'wb') as part_file:
+                while not self._stopped.is_set():
+                    chunk = response.read(DOWNLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    part_file.write(chunk)
+                    self.bytes_downloaded += len(chunk)
+                    verifier.update(chunk)
+                    self._put(chunk)
+
+            if self._stopped.is_set():
+                logger.warning('Download stopped before completion.')
+                return
+
+            size = self._resume_from + self.bytes_downloaded
+            if self._expected_size is not None and size < self._expected_size:
+                # The connection was cut, the '.part' file is resumed by the next run
+                raise IOError(f'Download interrupted at {size} of {self._expected_size} bytes.')
+            if self._expected_size is not None and size > self._expected_size:
+                raise DownloadVerificationError(f'Downloaded {size} bytes, expected {self._expected_size} bytes.')
+            verifier.verify()
+        except (DownloadVerificationError, zlib.error) as e:
+            logger.error(f'The downloaded tar file is corrupt, removing it. {e}')
+            remove_download(file_name)
+            self._finish(e, start)
+            return
+        except Exception as e:
+            logger.error(f'Failed to download tar file: {e}')
+            self._finish(e, start)
+            return
+
+        os.replace(part_file_name, file_name)
+        logger.info(f'Tar file downloaded successfully ({self.bytes_downloaded} bytes, '
+                    f'{self._resume_from} bytes resumed).')
+        self._finish(None, start)
+
+
+class GzipVerifier:
+    """
+    Verifies the gzip CRC and length trailers of a file as its bytes arrive, including files of several gzip members.
+    """
+
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self._members = 0
+        self._in_member = False
+
+    def update(self, data):
+        """
+        Decompresses the next bytes of the file and discards the output.
+
+        :param bytes data: The next bytes of the file.
+        :return: None
+        :rtype: None
+        :raises zlib.error: If the bytes are not valid gzip data or a trailer does not match.
+        """
+        while data:
+            self._in_member = True
+            # Decompress in bounded steps, so that a highly compressed chunk does not expand all at once
+            self._decompressor.decompress(data, DOWNLOAD_CHUNK_SIZE)
+            data = self._decompressor.unconsumed_tail
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data + data
+                self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                self._members += 1
+                self._in_member = False
+
+    def verify(self):
+        """
+        Checks that the file ended with a complete gzip member.
+
+        :return: None
+        :rtype: None
+        :raises zlib.error: If the file is empty or truncated.
+        """
+        if self._in_member or not self._members:
+            raise zlib.error('The gzip file is truncated.')
+
+
+def load_archive_meta(file_name=ARCHIVE_FILE_PATH):
+    """
+    Loads the response headers saved with a downloaded file.
+
+    :param str file_name: The downloaded file.
+    :return: The 'etag', 'last_modified' and 'content_length' headers, or an empty dict if none were saved.
+    :rtype: dict[str, str or None]
+    """
+    if not os.path.exists(f'{file_name}.json'):
+        return {}
+    with open(f'{file_name}.json', 'r') as f:
+        return json.load(f)
+
+
+def save_archive_meta(file_name, meta):
+    """
+    Saves the response headers of a downloaded file next to it, replacing the previous ones atomically.
+
+    :param str file_name: The downloaded file.
+    :param dict meta: The 'etag', 'last_modified' and 'content_length' headers.
+    :return: None
+    :rtype: None
+    """
+    with open(f'{file_name}.json.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(f'{file_name}.json.tmp', f'{file_name}.json')
+
+
+def remove_download(file_name=ARCHIVE_FILE_PATH):
+    """
+    Removes a downloaded file along with its partial download and saved response headers.
+
+    :param str file_name: The downloaded file.
+    :return: None
+    :rtype: None
+    """
+    for path in (file_name, f'{file_name}.part', f'{file_name}.json'):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def archive_identity():
+    """
+    Identifies the version of the GSOY archive opened by open_archive(), so that an interrupted run only resumes work
+    done on the same version.
+    The identity is taken from the ETag, Last-Modified and Content-Length headers of the download, or from the size and
+    modification time of a tar file that was downloaded by an older importer version. The tar file of a download
+    without these headers only exists once the download completes, so until then the identity is taken from the size
+    its '.part' file has reached, and the progress of the run is not resumed by the next run.
+
+    :return: The identity of the archive.
+    :rtype: str
+    """
+    meta = load_archive_meta()
+    if any(meta.values()):
+        return f'{meta.get("etag")}|{meta.get("last_modified")}|{meta.get("content_length")}'
+    for path in (ARCHIVE_FILE_PATH, f'{ARCHIVE_FILE_PATH}.part'):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        return f'{stat.st_size}|{int(stat.st_mtime)}'
+    # The download has not created its '.part' file yet
+    return f'0|{int(time.time())}'
+
+
+def conditional_headers(file_name, meta):
+    """
+    Builds the headers of a conditional request for a downloaded file, from its saved ETag and Last-Modified
+    validators, or from its modification time if it was downloaded by an older importer version.
+
+    :param str file_name: The downloaded file.
+    :param dict meta: The response headers saved with the file.
+    :return: The If-None-Match and If-Modified-Since headers.
+    :rtype: dict[str, str]
+    """
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    headers['If-Modified-Since'] = meta.get('last_modified') or formatdate(os.path.getmtime(file_name), usegmt=True)
+    return headers
+
+
+def archive_changed():
+    """
+    Asks the server whether the GSOY archive changed since it was downloaded, with a conditional HEAD request that
+    transfers no body. Servers that ignore the conditions are answered by comparing the response headers with the
+    headers saved with the download.
+
+    :return: Whether the archive on the server differs from the local tar file, or there is no local tar file.
+    :rtype: bool
+    :raises urllib.error.URLError: If the server cannot be reached.
+    """
+    file_name = ARCHIVE_FILE_PATH
+    if not os.path.exists(file_name):
+        return True
+
+    meta = load_archive_meta(file_name)
+    request = urllib.request.Request(GSOY_DOWNLOAD_URL, headers=conditional_headers(file_name, meta), method='HEAD')
+    try:
+        with urllib.request.urlopen(request) as response:
+            remote = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content_length': response.headers.get('Content-Length'),
+            }
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            return False
+        raise
+
+    if not any(meta.values()):
+        # A tar file downloaded by an older importer version is only known by its modification time
+        return True
+    return any(remote[name] is not None and remote[name] != meta.get(name) for name in remote)
+
+
+def open_archive(revalidate=True):
+    """
+    Opens the GSOY tar archive for reading.
+    If the tar file was downloaded before, a conditional request with its ETag and Last-Modified validators asks the
+    server whether it changed, and the local file is opened if it did not. If the server cannot be reached, the local
+    file is opened as well. A tar file downloaded by an older importer version, without saved validators, is
+    revalidated by its modification time.
+    Otherwise, the archive is streamed from the download URL while it is downloaded, and is saved to the target
+    directory on the way. A partial download left by an interrupted run is resumed with a Range request, if the server
+    still has the same version of the archive.
+
+    :param bool revalidate: Whether to ask the server if a local tar file changed. Without, it is opened as it is.
+    :return: The binary file object of the gzipped tar archive.
+    :rtype: io.RawIOBase
+    """
+    os.makedirs(GSOY_DATA_DIR, exist_ok=True)
+
+    file_name = ARCHIVE_FILE_PATH
+    part_file_name = f'{file_name}.part'
+    meta = load_archive_meta(file_name)
+    validator = meta.get('etag') or meta.get('last_modified')
+    headers = {}
+
+    if os.path.exists(file_name):
+        if not revalidate:
+            return open(file_name, 'rb')
+        headers.update(conditional_headers(file_name, meta))
+    elif os.path.exists(part_file_name) and validator:
+        headers['Range'] = f'bytes={os.path.getsize(part_file_name)}-'
+        headers['If-Range'] = validator
+
+    try:
+        response = urllib.request.urlopen(urllib.request.Request(GSOY_DOWNLOAD_URL, headers=headers))
+    except urllib.error.HTTPError as e:
+        if e.code == 304:
+            logger.info('The tar file was not modified since it was downloaded. Skipping download.')
+            return open(file_name, 'rb')
+        if e.code == 416:
+            logger.warning('The partial download does not fit the tar file on the server. Downloading again.')
+            remove_download(file_name)
+            return open_archive()
+        raise
+    except urllib.error.URLError as e:
+        if not os.path.exists(file_name):
+            raise
+        logger.warning(f'Could not revalidate the tar file, opening the local file. {e}')
+        return open(file_name, 'rb')
+
+    resume_from = 0
+    expected_size = response.headers.get('Content-Length')
+    expected_size = int(expected_size) if expected_size is not None else None
+    if response.status == 206:
+        resume_from = os.path.getsize(part_file_name)
+        # Content-Range: bytes <first>-<last>/<complete length>
+        complete_length = response.headers.get('Content-Range', '').rpartition('/')[2]
+        expected_size = int(complete_length) if complete_length.isdigit() else None
+        logger.info(f'Resuming download of the tar file from byte {resume_from}...')
+    else:
+        # The server sent the whole archive, a new version or one that cannot be resumed
+        remove_download(file_name)
+        save_archive_meta(file_name, {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_length': str(expected_size) if expected_size is not None else None,
+        })
+        logger.info(f'Streaming tar file from {GSOY_DOWNLOAD_URL}...')
+
+    return DownloadStream(response, file_name, resume_from, expected_size)
@@ -0,0 +1,231 @@
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+from config import FINGERPRINTS_FILE_PATH, SHARD_DIR
+from lineprotocol import decode_series
+
+# A fingerprint is the hash of a (country_iso, measurement, year) key and the hash of the fields stored for it
+FINGERPRINT_DTYPE = np.dtype([('key', '<u8'), ('value', '<u8')])
+
+
+def key_hash(country_iso, measurement, year):
+    """
+    Hashes the key of a point to 64 bits.
+
+    :param str country_iso: The country ISO tag of the point.
+    :param str measurement: The measurement name of the point.
+    :param year: The year of the point.
+    :type year: str or int
+    :return: The key hash.
+    :rtype: int
+    """
+    digest = hashlib.blake2b(f'{country_iso}\x1f{measurement}\x1f{int(year)}'.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def value_bits(values):
+    """
+    Gets the bit patterns of values, so that values compare exactly.
+
+    :param values: The values.
+    :type values: Sequence[float] or numpy.ndarray
+    :return: The bit patterns as unsigned 64 bit integers.
+    :rtype: numpy.ndarray
+    """
+    return np.asarray(values, dtype='<f8').view('<u8')
+
+
+def fields_hash(values, minimums, maximums, station_counts):
+    """
+    Hashes the fields of records to 64 bits, by mixing the bit patterns of the fields FNV-1a style.
+
+    :param values: The mean values of the records.
+    :param minimums: The minimum values of the records.
+    :param maximums: The maximum values of the records.
+    :param station_counts: The station counts of the records.
+    :type values, minimums, maximums, station_counts: Sequence or numpy.ndarray
+    :return: The hashes as unsigned 64 bit integers.
+    :rtype: numpy.ndarray
+    """
+    hashes = np.full(len(values), 0xcbf29ce484222325, dtype='<u8')
+    for field in (value_bits(values), value_bits(minimums), value_bits(maximums),
+                  np.asarray(station_counts, dtype='<i8').view('<u8')):
+        hashes = (hashes ^ field) * np.uint64(0x100000001b3)
+    return hashes
+
+
+def record_fingerprints(records, measurements, countries):
+    """
+    Gets the key hashes and field hashes of aggregated records.
+
+    :param numpy.ndarray records: The records, in aggregate.RECORD_DTYPE.
+    :param list[str] measurements: The measurement names, indexed by the measurement column of the records.
+    :param list[str] countries: The country ISO codes, indexed by the country column of the records.
+    :return: The key hashes and the field hashes.
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    keys = np.fromiter((key_hash(countries[country], measurements[measurement], year)
+                        for country, measurement, year in zip(records['country'].tolist(),
+                                                              records['measurement'].tolist(),
+                                                              records['year'].tolist())),
+                       dtype='<u8', count=len(records))
+    return keys, fields_hash(records['value'], records['min'], records['max'], records['station_count'])
+
+
+def batch_keys(batch):
+    """
+    Gets the key hashes of the points of encoded line protocol, like of a batch that could not be written.
+
+    :param bytes batch: Newline terminated line protocol.
+    :return: The key hashes.
+    :rtype: numpy.ndarray
+    """
+    series = decode_series(batch)
+    return np.fromiter((key_hash(country_iso, measurement, year) for measurement, country_iso, year in series),
+                       dtype='<u8', count=len(series))
+
+
+class FingerprintStore:
+    """
+    The fingerprints of the points in the database, as a memory-mapped array sorted by key hash.
+
+    The store is only opened by the main process, once the records of the run are aggregated. Lookups are vectorized
+    binary searches over the mapped file, so the store is not loaded into memory and only the pages the lookups touch
+    are read.
+    """
+
+    def __init__(self, path=FINGERPRINTS_FILE_PATH):
+        self.path = path
+        if os.path.exists(path):
+            self._fingerprints = np.load(path, mmap_mode='r')
+        else:
+            self._fingerprints = np.empty(0, dtype=FINGERPRINT_DTYPE)
+
+    def __len__(self):
+        return len(self._fingerprints)
+
+    def changed(self, keys, values):
+        """
+        Checks which points differ from the points stored in the database.
+
+        :param numpy.ndarray keys: The key hashes of the points.
+        :param numpy.ndarray values: The field hashes of the points.
+        :return: A mask of the points that are new or have different fields.
+        :rtype: numpy.ndarray
+        """
+        stored = self._fingerprints
+        if not len(stored):
+            return np.ones(len(keys), dtype=bool)
+
+        positions = np.minimum(np.searchsorted(stored['key'], keys), len(stored) - 1)
+        found = stored['key'][positions] == keys
+        return ~(found & (stored['value'][positions] == values))
+
+    def merge(self, keys, values):
+        """
+        Records the fingerprints of written points and saves the store, replacing the previous file atomically.
+        A new fingerprint replaces the stored one of the same key.
+
+        :param numpy.ndarray keys: The key hashes of the written points.
+        :param numpy.ndarray values: The field hashes of the written points.
+        :return: None
+        :rtype: None
+        """
+        new = np.empty(len(keys), dtype=FINGERPRINT_DTYPE)
+        new['key'] = keys
+        new['value'] = values
+        # np.unique keeps the first occurrence of a key, so the new fingerprints go first
+        combined = np.concatenate([new[::-1], np.asarray(self._fingerprints)])
+        _, first = np.unique(combined['key'], return_index=True)
+        self._save(combined[first])
+
+    def replace(self, fingerprints):
+        """
+        Replaces all fingerprints of the store and saves it.
+
+        :param numpy.ndarray fingerprints: The fingerprints, in FINGERPRINT_DTYPE.
+        :return: None
+        :rtype: None
+        """
+        _, first = np.unique(fingerprints['key'], return_index=True)
+        self._save(fingerprints[first])
+
+    def _save(self, fingerprints):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(f'{self.path}.tmp', 'wb') as f:
+            np.save(f, fingerprints)
+        os.replace(f'{self.path}.tmp', self.path)
+        self._fingerprints = np.load(self.path, mmap_mode='r')
+
+
+def store_path(shard=None):
+    """
+    Gets the path of the fingerprint store of an import.
+    A shard by country keeps its own store, while the shards by station share one store in SHARD_DIR, since the
+    coordinator that writes their points can be a different shard on every run.
+
+    :param shard: The shard of the import, or None for an unsharded import.
+    :type shard: sharding.Shard or None
+    :return: The path of the store.
+    :rtype: str
+    """
+    if shard is None:
+        return FINGERPRINTS_FILE_PATH
+    if shard.by == 'station':
+        return os.path.join(SHARD_DIR, os.path.basename(FINGERPRINTS_FILE_PATH))
+    return shard.local_path(FINGERPRINTS_FILE_PATH)
+
+
+def rebuild_from_db(path=FINGERPRINTS_FILE_PATH):
+    """
+    Rebuilds a fingerprint store from the points in the database, for when the store file is lost.
+    The store holds the fingerprints of all points, also for the store of a shard, which only looks up the points of
+    its own countries.
+
+    :param str path: The store to rebuild, like store_path() of a shard.
+    :return: The number of fingerprints.
+    :rtype: int
+    """
+    from config import BUCKET
+    from influx import client
+    from logging_config import logger
+
+    # Points written before the min, max and station_count fields existed hash as NaN, so they are rewritten once
+    query = f'from(bucket: "{BUCKET}") |> range(start: 1700-01-01T00:00:00Z) ' \
+            f'|> filter(fn: (r) => r["_measurement"] != "metadata") ' \
+            f'|> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")'
+
+    logger.info('Rebuilding fingerprints from the database...')
+    keys, fields = [], []
+    for record in client.query_api().query_stream(query):
+        keys.append(key_hash(record.values.get('country_iso'), record.get_measurement(), record.get_time().year))
+        fields.append(tuple(float('nan') if record.values.get(field) is None else record.values[field]
+                            for field in ('value', 'min', 'max')) + (record.values.get('station_count') or 0,))
+
+    values, minimums, maximums, station_counts = zip(*fields) if fields else ((), (), (), ())
+    fingerprints = np.empty(len(keys), dtype=FINGERPRINT_DTYPE)
+    fingerprints['key'] = np.asarray(keys, dtype='<u8')
+    fingerprints['value'] = fields_hash(values, minimums, maximums, station_counts)
+    FingerprintStore(path).replace(fingerprints)
+    logger.info(f'Rebuilt {len(fingerprints)} fingerprints in {path}.')
+    return len(fingerprints)
+
+
+if __name__ == '__main__':
+    from sharding import Shard, SHARD_BY
+
+    parser = argparse.ArgumentParser(description='Manages the fingerprints of the points in the database.')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild the fingerprints from the database.')
+    parser.add_argument('--shard', help='The store of shard i of N, given as "i/N" counting from 1.')
+    parser.add_argument('--shard-by', choices=SHARD_BY, default='country',
+                        help='Whether the shards split the station files by their country or by station.')
+    args = parser.parse_args()
+    path = store_path(Shard.parse(args.shard, args.shard_by) if args.shard else None)
+
+    if args.rebuild:
+        rebuild_from_db(path)
+    else:
+        print(f'{len(FingerprintStore(path))} fingerprints in {path}')
@@ -1,91 +1,496 @@
+import argparse
+import collections
 import concurrent.futures
-import csv
 import os
+import time
 
-from config import FIELD_MAPPING, GSOY_DATA_DIR, FIPS_MAPPING
-from influx import write_points_to_db
+import numpy as np
+
+from aggregate import SERIES_MEASUREMENTS, COUNTRIES, country_fips, country_indices, rollup_records, series_order
+from config import BATCH_SIZE, FINGERPRINTS_FILE_PATH, JOURNAL_FILE_PATH, JOURNAL_WRITE_INTERVAL, MANIFEST_FILE_PATH, \
+    RUN_REPORT_FILE_PATH, SELECTIVE_JOURNAL_FILE_PATH, SHARD_DIR, SNAPSHOT_FILE_PATH
+from download import DownloadStream, open_archive, archive_identity
+from fingerprints import FingerprintStore, record_fingerprints, store_path
+from journal import ImportJournal
+from lineprotocol import LineProtocolEncoder
 from logging_config import logger
-from util import update_last_run, download_and_extract_data, remove_extracted_data
+from parsing import parse_file
+from report import RunReport
+from selection import Selection
+from sharding import Shard, SHARD_BY
+from sinks import FanOutSink, SnapshotSink, load_snapshot
+from util import update_last_run, update_data_version, record_run_summary, iter_station_files, remove_extracted_data, \
+    load_manifest, save_manifest, manifest_entry, is_unchanged
+from writer import BatchWriter
+
+PARSE_WORKERS = os.cpu_count() or 1
+
+
+def parse_file_timed(*args):
+    """
+    Parses a station file like parsing.parse_file(), and measures the processor time of the parse in the worker.
 
-MAX_WORKERS = 4
+    :return: The processor time in seconds, and the result of parse_file().
+    :rtype: tuple[float, tuple or None]
+    """
+    start = time.process_time()
+    parsed = parse_file(*args)
+    return time.process_time() - start, parsed
 
 
-def import_file(filename):
-    logger.info(f'Importing data from {filename}')
-    if filename.endswith('.csv'):
-        file_path = os.path.join(GSOY_DATA_DIR, "extracted_data", filename)
-        country_fips_code = filename[:2]
+def timed(iterable, report, stage):
+    """
+    Iterates over an iterable, and counts the time spent in getting every item to a stage of the run report.
 
-        if country_fips_code not in FIPS_MAPPING.keys():
-            logger.error(f'No country found for "FIPS:{country_fips_code}"')
+    :param iterable: The iterable.
+    :param RunReport report: The run report.
+    :param str stage: The telemetry stage.
+    :return: A generator of the items.
+    :rtype: Iterator
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        item = next(iterator, StopIteration)
+        report.count(stage, time.perf_counter() - start)
+        if item is StopIteration:
             return
+        yield item
 
-        # country_name = FIPS_MAPPING[country_fips_code].get('country_name', None)
-        country_iso = FIPS_MAPPING[country_fips_code].get('country_iso', None)
-
-        with open(file_path, 'r') as file:
-            points = []
-            csv_reader = csv.reader(file)
-            headers = next(csv_reader)
-
-            for row in csv_reader:
-                # station = row[0]
-                time = f'{row[1]}-01-01T00:00:00.000Z'
-                # latitude = row[2]
-                # longitude = row[3]
-                # elevation = row[4]
-                # station_name = row[5]
-
-                for i, field_value in enumerate(row):
-                    field_name = headers[i]
-                    if field_name not in FIELD_MAPPING:
-                        # Filter out fields that are not in the mapping
-                        continue
 
-                    human_readable_name = FIELD_MAPPING.get(field_name, {}).get('name', field_name)
-                    value = row[headers.index(field_name)]
-                    if value == '':
+def count_download(report, archive):
+    """
+    Counts the download of a streamed archive to the run report, and takes the time that the decoder waited for the
+    download off the decompression time.
+
+    :param RunReport report: The run report.
+    :param archive: The archive that was read.
+    :return: None
+    :rtype: None
+    """
+    if isinstance(archive, DownloadStream):
+        report.count('download', archive.download_s, bytes=archive.bytes_downloaded)
+        report.count('decompression', -archive.wait_s)
+
+
+def find_changed_countries(archive, previous_manifest, shard=None, report=None):
+    """
+    Scans the archive for the countries whose station files changed since the last run.
+    A country changed if one of its station files is new, has different contents or was removed from the archive. The
+    stations of all FIPS codes of an ISO country are aggregated together, so they are all imported again then.
+
+    :param archive: The binary file object of the gzipped tar archive, closed once it has been scanned.
+    :param dict previous_manifest: The manifest of the last run.
+    :param shard: The shard to scan the station files of, or None for all station files.
+    :type shard: Shard or None
+    :param report: The run report to count the decompression of the scan to, which count_download() takes the wait for
+     the download off.
+    :type report: RunReport or None
+    :return: The FIPS codes of the changed countries, and the manifest entries of all station files in the archive.
+    :rtype: tuple[set[str], dict]
+    """
+    report = report or RunReport()
+    changed = set()
+    manifest = {}
+    with archive:
+        for filename, member, file in timed(iter_station_files(archive), report, 'decompression'):
+            if shard is not None and not shard.owns(filename):
+                continue
+            previous_entry = previous_manifest.get(filename)
+            if is_unchanged(member, previous_entry):
+                manifest[filename] = previous_entry
+                continue
+
+            read_start = time.perf_counter()
+            data = file.read()
+            report.count('decompression', time.perf_counter() - read_start, bytes=len(data))
+            entry = manifest_entry(member, data)
+            manifest[filename] = entry
+            if previous_entry is None or previous_entry['hash'] != entry['hash']:
+                changed.add(filename[:2])
+
+    changed.update(filename[:2] for filename in previous_manifest.keys() - manifest.keys())
+    changed = country_fips(changed)
+    logger.info(f'Found {len(changed)} countries with changed station files.')
+    return changed, manifest
+
+
+def write_records(records, fingerprint_store, batch_writer, journal, force=False, report=None):
+    """
+    Writes the aggregated records whose fields differ from the fingerprint store.
+    The records are written in series order, so every batch covers a few series in time order. The order is fixed, and
+    the number of written records is journaled every JOURNAL_WRITE_INTERVAL records, so a resumed run skips the records
+    that an earlier run already wrote.
+
+    :param numpy.ndarray records: The yearly and rollup records, in aggregate.RECORD_DTYPE.
+    :param FingerprintStore fingerprint_store: The fingerprints of the points in the database.
+    :param batch_writer: The writer to send the records with, a BatchWriter or a sink of the sinks module.
+    :param ImportJournal journal: The journal of the run.
+    :param bool force: Whether to write all records, even those that match the fingerprint store.
+    :param report: The run report to count the encoding and writing telemetry to.
+    :type report: RunReport or None
+    :return: The key hashes and field hashes of the written records.
+    :rtype: tuple[numpy.ndarray, numpy.ndarray]
+    """
+    report = report or RunReport()
+    # The time between two writes is spent in encoding, including the ordering and fingerprinting of the records
+    encoding_start = time.perf_counter()
+    records = records[series_order(records)]
+    keys, fields = record_fingerprints(records, SERIES_MEASUREMENTS, COUNTRIES)
+    if not force:
+        changed = fingerprint_store.changed(keys, fields)
+        records, keys, fields = records[changed], keys[changed], fields[changed]
+    if journal.written:
+        logger.info(f'Skipping {journal.written} points written before the import was resumed.')
+
+    def write(batch):
+        nonlocal encoding_start
+        write_start = time.perf_counter()
+        report.count('encoding', write_start - encoding_start, bytes=len(batch))
+        batch_writer.write(batch)
+        encoding_start = time.perf_counter()
+        report.count('writing', encoding_start - write_start)
+
+    encoder = LineProtocolEncoder(BATCH_SIZE)
+    for chunk_start in range(journal.written, len(records), JOURNAL_WRITE_INTERVAL):
+        chunk = records[chunk_start:chunk_start + JOURNAL_WRITE_INTERVAL]
+        for country, measurement, year, value, minimum, maximum, station_count in zip(
+                chunk['country'].tolist(), chunk['measurement'].tolist(), chunk['year'].tolist(),
+                chunk['value'].tolist(), chunk['min'].tolist(), chunk['max'].tolist(),
+                chunk['station_count'].tolist()):
+            batch = encoder.add(SERIES_MEASUREMENTS[measurement], COUNTRIES[country], year, value, minimum, maximum,
+                                station_count)
+            if batch is not None:
+                write(batch)
+
+        batch = encoder.flush()
+        if batch is not None:
+            write(batch)
+        flush_start = time.perf_counter()
+        report.count('encoding', flush_start - encoding_start, points=len(chunk))
+        batch_writer.flush()
+        encoding_start = time.perf_counter()
+        report.count('writing', encoding_start - flush_start)
+        journal.record_written(chunk_start + len(chunk))
+
+    report.count('encoding', time.perf_counter() - encoding_start)
+    return keys, fields
+
+
+def close_sink(sink, report):
+    """
+    Closes the sink of a run, and adds its figures to the run report.
+
+    :param sink: The BatchWriter or sink of the run.
+    :param RunReport report: The run report.
+    :return: None
+    :rtype: None
+    """
+    close_start = time.perf_counter()
+    sink.close()
+    report.count('writing', time.perf_counter() - close_start, points=sink.written_points)
+    report.write_latencies = list(sink.latencies)
+    report.failed_batches = sink.failed_batches
+
+
+def acknowledged(sink, keys, fields):
+    """
+    Drops the fingerprints of the points of the batches that failed to write, so that only the points the database
+    acknowledged are recorded as written. Spooled points are written again by the next run.
+
+    :param sink: The closed BatchWriter or sink of the run.
+    :param np.ndarray keys: The key hashes of the written points.
+    :param np.ndarray fields: The field hashes of the written points.
+    :return: The key hashes and the field hashes of the acknowledged points.
+    :rtype: tuple[np.ndarray, np.ndarray]
+    """
+    if not sink.failed_keys:
+        return keys, fields
+    mask = ~np.isin(keys, np.concatenate(sink.failed_keys))
+    return keys[mask], fields[mask]
+
+
+def import_data(shard=None, selection=None, sink=None, offline=False, snapshot_path=None):
+    """
+    Imports the station files of the GSOY archive as yearly country aggregates.
+    The values of all stations of a country are reduced to one point per measurement and year, holding their mean as
+    the value along with their minimum, maximum and station count, which is roughly a thousand times fewer points than
+    the station values.
+    The archive is downloaded on a background thread and decompressed in the current thread as the bytes arrive. The
+    station files are parsed into compact arrays on a process pool of PARSE_WORKERS processes, with at most
+    2 * PARSE_WORKERS files in flight, and reduced in the current thread by a CountryAggregator. Once all station files
+    are parsed, the aggregated points are written to the database.
+    Batches spooled by a previous run are replayed first.
+    If there is a manifest of the last run, the archive is scanned first for the countries whose station files changed,
+    and only the station files of those countries are parsed again, since a country aggregate needs all of its
+    stations. Points whose fields match the fingerprint store are not written, and the fingerprints of the written
+    points are merged into the store at the end of the run.
+    The progress of the run is kept in an ImportJournal, so a run that is interrupted resumes with the scan, station
+    files and writes that were not finished yet. The journal is removed once the run has finished.
+    A sharded import only imports the station files of its shard, and keeps its manifest, fingerprints and journal in a
+    directory of the shard. A shard by station cannot know which countries changed, as the other stations of a country
+    are in other shards, so it always imports all of its station files, and its partial aggregate is written by the
+    coordinator of the run. The coordinator calls update_last_run() once all shards have finished.
+    A selective import repairs the selected countries, measurements and years: it imports all station files of the
+    selected countries and writes all of their selected points, but does not update the manifest or the last run time,
+    which describe full imports. It updates the data version instead, so that the API drops its cached responses.
+    The yearly records are rolled up to the periods of ROLLUP_RESOLUTIONS, like decades, which are written as
+    '<measurement>_<resolution>' measurements along with them.
+    The aggregated records can also be kept in a columnar snapshot file, fed by the same run as the database. The
+    records of the countries, measurements and years that the run aggregated again replace those in the snapshot.
+
+    :param shard: The shard to import, or None to import all station files.
+    :type shard: Shard or None
+    :param selection: The countries, measurements and years to import, or None to import everything.
+    :type selection: Selection or None
+    :param sink: The sink of the encoded points, like a sinks.NullSink. A BatchWriter to the database by default.
+    :param bool offline: Whether to open the local archive without revalidating it, and leave the last run time in the
+     database unchanged, for benchmarks and trial runs.
+    :param snapshot_path: The snapshot file to save the aggregated records to, next to the sink, or None.
+    :type snapshot_path: str or None
+    :return: The figures of the run.
+    :rtype: dict
+    """
+    report = RunReport()
+    station_shard = shard is not None and shard.by == 'station'
+    local_path = shard.local_path if shard is not None else (lambda path: path)
+    incremental = not station_shard and selection is None
+    previous_manifest = load_manifest(local_path(MANIFEST_FILE_PATH)) if incremental else {}
+    archive = open_archive(revalidate=not offline)
+    identity = archive_identity()
+    if selection is None:
+        journal = ImportJournal(identity, local_path(JOURNAL_FILE_PATH))
+    else:
+        logger.info(f'Importing the selection {selection}.')
+        journal = ImportJournal(f'{identity}|{selection}', SELECTIVE_JOURNAL_FILE_PATH)
+    report.resumed_files = len(journal.files)
+    coordinator = False
+
+    def wait_for(future, filename, entry):
+        try:
+            seconds, parsed = future.result()
+        except Exception as e:
+            logger.error(f'Failed to parse station file {filename}, {e}')
+            # The country aggregate misses this station, so the country is imported again on the next run
+            journal.record_file(filename, None, None)
+            return
+        report.files += 1
+        report.count('parsing', seconds, bytes=entry['size'], values=len(parsed[3]) if parsed is not None else 0)
+        journal.record_file(filename, entry, parsed)
+
+    try:
+        if previous_manifest and journal.countries is None:
+            with report.stage('scan'):
+                journal.record_scan(*find_changed_countries(archive, previous_manifest, shard, report))
+            count_download(report, archive)
+            archive = open_archive(revalidate=False) if journal.countries else None
+        elif journal.countries is not None and not journal.countries:
+            archive.close()
+            archive = None
+
+        if sink is None:
+            sink = BatchWriter()
+            sink.replay_spool()
+        if snapshot_path is not None:
+            # Like the fingerprints, the snapshot of a shard by station is written by the coordinator of each run
+            snapshot_path = os.path.join(SHARD_DIR, os.path.basename(snapshot_path)) if station_shard \
+                else local_path(snapshot_path)
+            sink = FanOutSink(sink, SnapshotSink(snapshot_path))
+
+        if archive is not None:
+            with report.stage('parse'), archive, \
+                    concurrent.futures.ProcessPoolExecutor(max_workers=PARSE_WORKERS) as executor:
+                parsing = collections.deque()
+                for filename, member, file in timed(iter_station_files(archive), report, 'decompression'):
+                    if (shard is not None and not shard.owns(filename)) or filename in journal.files:
+                        continue
+                    if selection is not None and not selection.owns(filename):
+                        continue
+                    if journal.countries is not None and filename[:2] not in journal.countries:
+                        report.skipped_files += 1
                         continue
-                    fields = {
-                        'value': float(row[headers.index(field_name)]),
-                        # 'station': station,
-                        # 'latitude': latitude,
-                        # 'longitude': longitude,
-                        # 'elevation': elevation,
-                        # 'station_name': station_name,
-                        # 'country_name': country_name
-                    }
-
-                    data = {
-                        'measurement': human_readable_name,
-                        'tags': {
-                            'country_iso': country_iso,
-                        },
-                        'time': time,
-                        'fields': fields
-                    }
-
-                    points.append(data)
-    write_points_to_db(points)
-
-
-def import_data():
-    logger.info('Starting download...')
-    download_and_extract_data()
-    logger.info('Download and extraction complete.')
-
-    extracted_data_dir = os.path.join(GSOY_DATA_DIR, 'extracted_data')
-    filenames = os.listdir(extracted_data_dir)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        executor.map(import_file, filenames)
-
-    update_last_run()
 
+                    read_start = time.perf_counter()
+                    data = file.read()
+                    report.count('decompression', time.perf_counter() - read_start, bytes=len(data))
+                    if len(parsing) >= 2 * PARSE_WORKERS:
+                        wait_for(*parsing.popleft())
+                    if selection is None:
+                        future = executor.submit(parse_file_timed, filename, data)
+                    else:
+                        future = executor.submit(parse_file_timed, filename, data, selection.measurements,
+                                                 selection.years)
+                    parsing.append((future, filename, manifest_entry(member, data)))
 
-if __name__ == '__main__':
-    logger.info('Starting import')
-    import_data()
-    logger.info('Import finished')
-    logger.info('Removing extracted data')
+                while parsing:
+                    wait_for(*parsing.popleft())
+            count_download(report, archive)
+        else:
+            report.skipped_files = len(journal.scan_manifest)
+
+        report.values = journal.aggregator.num_values
+        with report.stage('aggregate'):
+            if station_shard:
+                coordinator = shard.finish(identity, journal.aggregator)
+                aggregator = shard.merge(identity) if coordinator else None
+            else:
+                aggregator = journal.aggregator
+            fingerprint_store = FingerprintStore(store_path(shard))
+            records = aggregator.records() if aggregator is not None else None
+
+        written_keys, written_fields = np.empty(0, dtype='<u8'), np.empty(0, dtype='<u8')
+        with report.stage('write'):
+            try:
+                if records is not None:
+                    if selection is not None:
+                        countries = country_indices(selection.countries) if selection.countries is not None else None
+                        sink.put_records(records, countries, selection.measurements, selection.years)
+                        records = np.concatenate([records, rollup_records(records, selection.years)])
+                    else:
+                        sink.put_records(records, country_indices(journal.countries)
+                                         if journal.countries is not None else None)
+                        records = np.concatenate([records, rollup_records(records)])
+                    written_keys, written_fields = write_records(records, fingerprint_store, sink, journal,
+                                                                 force=selection is not None, report=report)
+            finally:
+                close_sink(sink, report)
+
+        written_keys, written_fields = acknowledged(sink, written_keys, written_fields)
+        report.points = len(written_keys)
+        if report.points:
+            fingerprint_store.merge(written_keys, written_fields)
+        if shard is not None and not station_shard:
+            coordinator = shard.finish(identity)
+    except BaseException:
+        # Keep the progress for the next run
+        journal.close()
+        raise
+
+    manifest = dict(journal.scan_manifest or {})
+    for filename, entry in journal.files.items():
+        if entry is None:
+            manifest.pop(filename, None)
+        else:
+            manifest[filename] = entry
+
+    if selection is not None:
+        logger.info('Selective import, the manifest and last run time are left unchanged.')
+        if not offline:
+            update_data_version('selective import')
+    elif offline:
+        save_manifest(manifest, local_path(MANIFEST_FILE_PATH))
+        if coordinator:
+            shard.clear(identity)
+    elif shard is None:
+        update_last_run(manifest)
+    else:
+        if not station_shard:
+            save_manifest(manifest, local_path(MANIFEST_FILE_PATH))
+        if coordinator:
+            update_last_run()
+            shard.clear(identity)
+    journal.clear()
+
+    summary = report.finish()
+    report.save(summary, local_path(RUN_REPORT_FILE_PATH))
+    if not offline:
+        record_run_summary(summary, shard.name if shard is not None else None)
+    return summary
+
+
+def restore_snapshot(path=SNAPSHOT_FILE_PATH, sink=None):
+    """
+    Writes all records of a snapshot to the database, to rebuild it without downloading and parsing the archive.
+    The restore is journaled like a selective import, so an interrupted restore resumes its writes, and updates the
+    data version like a selective import when it writes to the database.
+
+    :param str path: The snapshot file.
+    :param sink: The sink of the encoded points. A BatchWriter to the database by default.
+    :return: The figures of the restore.
+    :rtype: dict
+    """
+    report = RunReport()
+    to_db = sink is None
+    with report.stage('aggregate'):
+        records = load_snapshot(path)
+        records = np.concatenate([records, rollup_records(records)])
+    journal = ImportJournal(f'snapshot|{os.path.getsize(path)}|{int(os.path.getmtime(path))}',
+                            SELECTIVE_JOURNAL_FILE_PATH)
+    fingerprint_store = FingerprintStore(FINGERPRINTS_FILE_PATH)
+    if sink is None:
+        sink = BatchWriter()
+        sink.replay_spool()
+
+    try:
+        with report.stage('write'):
+            try:
+                written_keys, written_fields = write_records(records, fingerprint_store, sink, journal, force=True,
+                                                             report=report)
+            finally:
+                close_sink(sink, report)
+    except BaseException:
+        journal.close()
+        raise
+
+    written_keys, written_fields = acknowledged(sink, written_keys, written_fields)
+    report.points = len(written_keys)
+    fingerprint_store.merge(written_keys, written_fields)
+    journal.clear()
+    if to_db:
+        update_data_version('snapshot restore')
+    logger.info(f'Restored {report.points} points from the snapshot {path}.')
+    return report.finish()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Imports the GSOY archive into the database.')
+    parser.add_argument('--shard', help='Import shard i of N only, given as "i/N" counting from 1. The shards of a run '
+                                        'must share GSOY_SHARD_DIR.')
+    parser.add_argument('--shard-by', choices=SHARD_BY, default='country',
+                        help='Split the station files between the shards by their country or by station.')
+    parser.add_argument('--countries', help='Import these comma separated ISO or "FIPS:<code>" countries only.')
+    parser.add_argument('--measurements', help='Import these comma separated measurement names or GSOY element codes '
+                                               'only.')
+    parser.add_argument('--years', help='Import this year or year range, like "1950-2000", only.')
+    parser.add_argument('--snapshot', nargs='?', const=SNAPSHOT_FILE_PATH,
+                        help='Also save the aggregates to a columnar snapshot file, by default '
+                             f'{SNAPSHOT_FILE_PATH}.')
+    parser.add_argument('--restore-snapshot', nargs='?', const=SNAPSHOT_FILE_PATH,
+                        help='Write all aggregates of a snapshot file to the database instead of importing the '
+                             f'archive, by default {SNAPSHOT_FILE_PATH}.')
+    parser.add_argument('--daemon', action='store_true',
+                        help='Stay resident and import the archive whenever it changed, instead of importing once.')
+    args = parser.parse_args()
+    if args.daemon:
+        if args.shard or args.snapshot or args.restore_snapshot or args.countries or args.measurements or args.years:
+            parser.error('The daemon runs full incremental imports only.')
+        from scheduler import run_scheduler
+        run_scheduler()
+        return
+    if args.restore_snapshot:
+        if args.shard or args.snapshot or args.countries or args.measurements or args.years:
+            parser.error('A snapshot is restored on its own.')
+        logger.info(f'Restoring the snapshot {args.restore_snapshot}')
+        restore_snapshot(args.restore_snapshot)
+        logger.info('Restore finished')
+        return
+
+    shard = Shard.parse(args.shard, args.shard_by) if args.shard else None
+
+    selection = None
+    if args.countries or args.measurements or args.years:
+        if shard is not None:
+            parser.error('A selective import cannot be sharded.')
+        try:
+            selection = Selection.parse(args.countries, args.measurements, args.years)
+        except ValueError as e:
+            parser.error(str(e))
+
+    logger.info(f'Starting import{f" of {shard.name} by {shard.by}" if shard else ""}')
     remove_extracted_data()
-    logger.info('Removed extracted data')
+    import_data(shard, selection, snapshot_path=args.snapshot)
+    logger.info('Import finished')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+import itertools
 import time
 
 from influxdb_client import InfluxDBClient, WritePrecision
@@ -14,18 +15,15 @@ client = InfluxDBClient(
 )
 
 def write_points_to_db(points, batch_size=2000):
-    write_api = client.write_api(write_options=SYNCHRONOUS)
-    num_points = len(points)
-    logger.debug(f'Writing {num_points} points in batches of {batch_size} to db')
-
-    for i in range(0, len(points), batch_size):
-        batch = points[i:i + batch_size]
-        try:
-            write_api.write(bucket=BUCKET, record=batch, write_precision=WritePrecision.MS)
-        except Exception as e:
-            logger.error(f'Failed to write batch {i // batch_size + 1}, {e}')
-            write_api.__del__()
-    write_api.__del__()
+    with client.write_api(write_options=SYNCHRONOUS) as write_api:
+        points = iter(points)
+        logger.debug(f'Writing points in batches of {batch_size} to db')
+
+        for num_batch, batch in enumerate(iter(lambda: list(itertools.islice(points, batch_size)), []), start=1):
+            try:
+                write_api.write(bucket=BUCKET, record=batch, write_precision=WritePrecision.MS)
+            except Exception as e:
+                logger.error(f'Failed to write batch {num_batch}, {e}')
 
 
 def wait_for_db():
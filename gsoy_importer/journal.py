@@ -0,0 +1,198 @@
+import os
+import pickle
+import struct
+import zlib
+
+from aggregate import CountryAggregator
+from config import JOURNAL_FILE_PATH, JOURNAL_COMPACT_INTERVAL
+from logging_config import logger
+
+# Every journal record is framed by the length and CRC32 of its payload, so that a torn last record is detected
+RECORD_HEADER = struct.Struct('<II')
+
+
+class ImportJournal:
+    """
+    An append-only journal of the progress of an import run, so that a run that was killed resumes where it stopped.
+
+    The journal records the result of the scan for changed countries, every finished station file with its manifest
+    entry and parsed values, and the number of points written so far. Every JOURNAL_COMPACT_INTERVAL station files, the
+    journal is compacted into a single snapshot record holding the running state of the aggregation, so its size stays
+    bounded by the number of distinct keys.
+
+    Records are flushed to the operating system as they are appended, which survives the importer being killed or its
+    container being restarted. A torn last record is dropped when the journal is loaded. The journal belongs to one
+    version of the archive, given by its identity, and is discarded when a different version is imported.
+    """
+
+    def __init__(self, identity, path=JOURNAL_FILE_PATH):
+        self.identity = identity
+        self.path = path
+        self.countries = None
+        self.scan_manifest = None
+        self.files = {}
+        self.aggregator = CountryAggregator()
+        self.written = 0
+        self._files_since_compaction = 0
+        self._load()
+        self._file = open(path, 'ab')
+
+    def record_scan(self, countries, manifest):
+        """
+        Records the result of the scan for changed countries.
+
+        :param set[str] countries: The FIPS codes of the changed countries.
+        :param dict manifest: The manifest entries of all station files in the archive.
+        :return: None
+        :rtype: None
+        """
+        self.countries, self.scan_manifest = countries, manifest
+        self._append(('scan', countries, manifest))
+
+    def record_file(self, filename, entry, parsed):
+        """
+        Records a finished station file and adds its values to the aggregation.
+
+        :param str filename: The name of the station file.
+        :param entry: The manifest entry of the station file, or None if it failed to parse.
+        :type entry: dict or None
+        :param parsed: The arrays returned by parsing.parse_file(), or None.
+        :type parsed: tuple or None
+        :return: None
+        :rtype: None
+        """
+        self._apply_file(filename, entry, parsed)
+        self._append(('file', filename, entry, parsed))
+        self._files_since_compaction += 1
+        if self._files_since_compaction >= JOURNAL_COMPACT_INTERVAL:
+            self.compact()
+
+    def record_written(self, num_points):
+        """
+        Records the number of points written to the database so far.
+
+        :param int num_points: The number of points of the write phase whose writes finished.
+        :return: None
+        :rtype: None
+        """
+        self.written = num_points
+        self._append(('written', num_points))
+
+    def compact(self):
+        """
+        Replaces the journal atomically by a snapshot of the progress recorded so far.
+
+        :return: None
+        :rtype: None
+        """
+        snapshot = {
+            'countries': self.countries,
+            'scan_manifest': self.scan_manifest,
+            'files': self.files,
+            'aggregator': self.aggregator.state(),
+            'written': self.written,
+        }
+        with open(f'{self.path}.tmp', 'wb') as f:
+            f.write(_frame(('start', self.identity)))
+            f.write(_frame(('snapshot', snapshot)))
+            f.flush()
+            os.fsync(f.fileno())
+        self._file.close()
+        os.replace(f'{self.path}.tmp', self.path)
+        self._file = open(self.path, 'ab')
+        self._files_since_compaction = 0
+        logger.info(f'Compacted the import journal at {len(self.files)} station files.')
+
+    def close(self):
+        """
+        Closes the journal, keeping its progress for the next run.
+
+        :return: None
+        :rtype: None
+        """
+        self._file.close()
+
+    def clear(self):
+        """
+        Closes and removes the journal once the run has finished.
+
+        :return: None
+        :rtype: None
+        """
+        self._file.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _append(self, record):
+        self._file.write(_frame(record))
+        self._file.flush()
+
+    def _apply_file(self, filename, entry, parsed):
+        self.files[filename] = entry
+        if parsed is not None:
+            self.aggregator.add(*parsed)
+
+    def _load(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        if not os.path.exists(self.path):
+            self._start()
+            return
+
+        records, end = _read_records(self.path)
+        if not records or records[0] != ('start', self.identity):
+            logger.info('Found an import journal of another archive version, discarding it.')
+            self._start()
+            return
+
+        if end < os.path.getsize(self.path):
+            logger.warning(f'Dropping the torn last record of the import journal at byte {end}.')
+            with open(self.path, 'r+b') as f:
+                f.truncate(end)
+
+        for record in records[1:]:
+            if record[0] == 'snapshot':
+                snapshot = record[1]
+                self.countries, self.scan_manifest = snapshot['countries'], snapshot['scan_manifest']
+                self.files, self.written = snapshot['files'], snapshot['written']
+                self.aggregator = CountryAggregator.from_state(snapshot['aggregator'])
+            elif record[0] == 'scan':
+                self.countries, self.scan_manifest = record[1], record[2]
+            elif record[0] == 'file':
+                self._apply_file(*record[1:])
+            elif record[0] == 'written':
+                self.written = record[1]
+
+        logger.info(f'Resuming import from the journal: {len(self.files)} station files finished, '
+                    f'{self.written} points written.')
+
+    def _start(self):
+        with open(self.path, 'wb') as f:
+            f.write(_frame(('start', self.identity)))
+
+
+def _frame(record):
+    payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def _read_records(path):
+    """
+    Reads the records of a journal up to the first torn or corrupt record.
+
+    :param str path: The journal file.
+    :return: The records, and the offset after the last valid record.
+    :rtype: tuple[list[tuple], int]
+    """
+    records = []
+    end = 0
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    while end + RECORD_HEADER.size <= len(data):
+        length, crc = RECORD_HEADER.unpack_from(data, end)
+        payload = data[end + RECORD_HEADER.size:end + RECORD_HEADER.size + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            break
+        records.append(pickle.loads(payload))
+        end += RECORD_HEADER.size + length
+    return records, end
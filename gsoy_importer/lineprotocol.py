@@ -0,0 +1,128 @@
+import math
+import re
+from datetime import datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# The escape sequences of measurement names and tags, and the unescaped characters they stand for
+ESCAPED = re.compile(rb'\\([\\, =])')
+
+
+def escape_measurement(measurement):
+    """
+    Escapes a measurement name for InfluxDB line protocol.
+
+    :param str measurement: The measurement name.
+    :return: The escaped measurement name.
+    :rtype: str
+    """
+    return measurement.replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ')
+
+
+def escape_tag(tag):
+    """
+    Escapes a tag key or value for InfluxDB line protocol.
+
+    :param str tag: The tag key or value.
+    :return: The escaped tag key or value.
+    :rtype: str
+    """
+    return escape_measurement(tag).replace('=', '\\=')
+
+
+def year_to_ms(year):
+    """
+    Converts a year to the millisecond timestamp of its first instant in UTC. Years before 1970 are negative.
+
+    :param int year: The year.
+    :return: The timestamp in milliseconds.
+    :rtype: int
+    """
+    return (datetime(year, 1, 1, tzinfo=timezone.utc) - EPOCH) // timedelta(milliseconds=1)
+
+
+def decode_series(batch):
+    """
+    Decodes the series and years of the points of line protocol encoded by the LineProtocolEncoder.
+
+    :param bytes batch: Newline terminated line protocol.
+    :return: The measurement name, country ISO tag and year of every point.
+    :rtype: list[tuple[str, str, int]]
+    """
+    series = []
+    for line in batch.splitlines():
+        # The tags end at the first unescaped space, and the timestamp is the last field
+        key = re.split(rb'(?<!\\) ', line, maxsplit=1)[0]
+        measurement, tags = re.split(rb'(?<!\\),', key, maxsplit=1)
+        country_iso = tags.partition(b'=')[2]
+        timestamp = int(line.rpartition(b' ')[2])
+        series.append((ESCAPED.sub(rb'\1', measurement).decode(), ESCAPED.sub(rb'\1', country_iso).decode(),
+                       (EPOCH + timedelta(milliseconds=timestamp)).year))
+    return series
+
+
+class LineProtocolEncoder:
+    """
+    Encodes the yearly country records as InfluxDB line protocol with millisecond precision, straight into a reusable
+    buffer.
+
+    The escaped '<measurement>,country_iso=<iso> value=' prefix of every series and the ' <timestamp>\\n' suffix of
+    every year are encoded once and cached, so adding a record only formats its fields.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self._buffer = bytearray()
+        self._num_points = 0
+        self._prefixes = {}
+        self._suffixes = {}
+
+    def add(self, measurement, country_iso, year, value, min_value, max_value, station_count):
+        """
+        Adds a record to the buffer.
+
+        :param str measurement: The measurement name.
+        :param str country_iso: The country ISO tag.
+        :param int year: The year of the record.
+        :param float value: The mean of the station values. Non-finite values cannot be written and are dropped.
+        :param float min_value: The minimum of the station values.
+        :param float max_value: The maximum of the station values.
+        :param int station_count: The number of station values.
+        :return: The encoded batch if the buffer reached the batch size, otherwise None.
+        :rtype: bytes or None
+        """
+        if not math.isfinite(value):
+            return None
+
+        prefix = self._prefixes.get((measurement, country_iso))
+        if prefix is None:
+            prefix = f'{escape_measurement(measurement)},country_iso={escape_tag(country_iso)} value='.encode()
+            self._prefixes[(measurement, country_iso)] = prefix
+
+        suffix = self._suffixes.get(year)
+        if suffix is None:
+            suffix = f' {year_to_ms(year)}\n'.encode()
+            self._suffixes[year] = suffix
+
+        buffer = self._buffer
+        buffer += prefix
+        buffer += f'{value!r},min={min_value!r},max={max_value!r},station_count={station_count}i'.encode()
+        buffer += suffix
+        self._num_points += 1
+
+        if self._num_points >= self.batch_size:
+            return self.flush()
+        return None
+
+    def flush(self):
+        """
+        Takes the encoded records out of the buffer.
+
+        :return: The encoded batch, or None if the buffer is empty.
+        :rtype: bytes or None
+        """
+        if not self._num_points:
+            return None
+        batch = bytes(self._buffer)
+        self._buffer.clear()
+        self._num_points = 0
+        return batch
@@ -0,0 +1,97 @@
+import csv
+import io
+
+import numpy as np
+
+from aggregate import MEASUREMENT_INDEX
+from config import FIELD_MAPPING, FIPS_MAPPING
+from logging_config import logger
+
+
+def build_column_plan(headers):
+    """
+    Builds the projection plan of a station file from its header, so that rows only touch the mapped columns.
+
+    :param list[str] headers: The header row of the station file.
+    :return: The column index, measurement name and value converter of every column in FIELD_MAPPING.
+    :rtype: list[tuple[int, str, Callable[[str], float]]]
+    """
+    return [(index, FIELD_MAPPING[field_name].get('name', field_name), float)
+            for index, field_name in enumerate(headers) if field_name in FIELD_MAPPING]
+
+
+def read_values(csv_reader, plan):
+    """
+    Reads the mapped values of the remaining rows of a station file.
+
+    :param csv_reader: The CSV reader of the station file, positioned after the header.
+    :param list plan: The column plan built from the header.
+    :return: A generator of (measurement, year, value) tuples for the non-empty mapped cells, where the measurement is
+     the one given by the plan.
+    :rtype: Iterator[tuple[str, str, float]]
+    """
+    num_columns = max((index for index, _, _ in plan), default=-1) + 1
+
+    for row in csv_reader:
+        if len(row) < num_columns:
+            row += [''] * (num_columns - len(row))
+        # station = row[0]
+        year = row[1]
+        # latitude = row[2]
+        # longitude = row[3]
+        # elevation = row[4]
+        # station_name = row[5]
+
+        for index, measurement, convert in plan:
+            value = row[index]
+            if value == '':
+                continue
+            yield measurement, year, convert(value)
+
+
+def parse_file(filename, data, measurements=None, year_range=None):
+    """
+    Parses a GSOY station file into compact arrays for the aggregation.
+    This runs in the worker processes of the parse stage, so only these arrays travel back to the importer.
+
+    :param str filename: The name of the station file.
+    :param bytes data: The contents of the station file.
+    :param measurements: The indices of the measurements to parse, or None for all measurements. The column plan is
+     restricted to them, and the rows are not parsed at all if the station has none of them.
+    :type measurements: set[int] or None
+    :param year_range: The first and last year to keep, or None for all years.
+    :type year_range: tuple[int, int] or None
+    :return: The country ISO code of the station, and the measurement indices, years and values of its non-empty mapped
+     cells. None if the country of the station is unknown.
+    :rtype: tuple[str, numpy.ndarray, numpy.ndarray, numpy.ndarray] or None
+    """
+    logger.info(f'Importing data from {filename}')
+    country_fips_code = filename[:2]
+
+    if country_fips_code not in FIPS_MAPPING.keys():
+        logger.error(f'No country found for "FIPS:{country_fips_code}"')
+        return None
+
+    # country_name = FIPS_MAPPING[country_fips_code].get('country_name', None)
+    country_iso = FIPS_MAPPING[country_fips_code].get('country_iso', None)
+
+    csv_reader = csv.reader(io.StringIO(data.decode('utf-8'), newline=''))
+    plan = [(index, MEASUREMENT_INDEX[measurement], convert)
+            for index, measurement, convert in build_column_plan(next(csv_reader))
+            if measurements is None or MEASUREMENT_INDEX[measurement] in measurements]
+    if not plan:
+        return country_iso, np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int16), np.empty(0, dtype=np.float64)
+
+    measurement_indices, years, values = [], [], []
+    for measurement_index, year, value in read_values(csv_reader, plan):
+        measurement_indices.append(measurement_index)
+        years.append(year)
+        values.append(value)
+
+    measurement_indices = np.array(measurement_indices, dtype=np.uint16)
+    years = np.array(years, dtype=np.int16)
+    values = np.array(values, dtype=np.float64)
+    if year_range is not None:
+        selected = (years >= year_range[0]) & (years <= year_range[1])
+        measurement_indices, years, values = measurement_indices[selected], years[selected], values[selected]
+    return country_iso, measurement_indices, years, values
@@ -0,0 +1,193 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+import numpy as np
+import psutil
+
+from config import MEMORY_SAMPLE_INTERVAL_S
+from logging_config import logger
+
+# The stages of the data flow that the telemetry of a run breaks down
+TELEMETRY_STAGES = ('download', 'decompression', 'parsing', 'encoding', 'writing')
+
+
+class MemorySampler:
+    """
+    Samples the resident set size of the current process and of its child processes, like the parse workers, in a
+    background thread, and keeps their peaks.
+
+    Unlike ru_maxrss, which holds the peak of the whole life of a process, the peaks only cover the time the sampler
+    runs, so they are the peaks of a run also when the scheduler runs many imports in one process. A peak that lasts
+    shorter than the sample interval may be missed.
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL_S):
+        self.peak_rss = 0
+        self.peak_child_rss = 0
+        self._interval = interval
+        self._process = psutil.Process()
+        self._stopped = threading.Event()
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def sample(self):
+        """
+        Takes a sample of the resident set size of the process and its child processes.
+
+        :return: None
+        :rtype: None
+        """
+        self.peak_rss = max(self.peak_rss, self._process.memory_info().rss)
+        for child in self._process.children(recursive=True):
+            try:
+                self.peak_child_rss = max(self.peak_child_rss, child.memory_info().rss)
+            except psutil.Error:
+                # The child exited since it was listed
+                pass
+
+    def stop(self):
+        """
+        Stops the sampling, after a last sample.
+
+        :return: None
+        :rtype: None
+        """
+        self._stopped.set()
+        self._thread.join()
+        self.sample()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            self.sample()
+
+
+def latency_percentiles(latencies):
+    """
+    Summarizes write latencies.
+
+    :param list[float] latencies: The latencies in seconds.
+    :return: The 50th, 90th and 99th percentile and the maximum, or an empty dict without latencies.
+    :rtype: dict[str, float]
+    """
+    if not latencies:
+        return {}
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).tolist()
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(latencies)}
+
+
+class RunReport:
+    """
+    Collects the figures of an import run.
+
+    The wall clock time of the phases of the run is taken with stage(). The download, decompression and parsing run
+    overlapped within the parse phase, so the telemetry of the data flow is collected separately with count(): the
+    time spent in each of TELEMETRY_STAGES, and the bytes, values or points that passed through it.
+    The memory of the importer and its workers is sampled during the stages, for the peak RSS of the run.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.finished = None
+        self.files = 0
+        self.skipped_files = 0
+        self.resumed_files = 0
+        self.values = 0
+        self.points = 0
+        self.stage_times = {}
+        self.telemetry = {stage: {'seconds': 0.0} for stage in TELEMETRY_STAGES}
+        self.write_latencies = []
+        self.failed_batches = 0
+        self.peak_rss = 0
+        self.peak_worker_rss = 0
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Times a stage of the run and samples its memory. The times of stages that run more than once add up.
+
+        :param str name: The name of the stage.
+        :return: A context manager around the stage.
+        """
+        start = time.perf_counter()
+        sampler = MemorySampler()
+        try:
+            yield
+        finally:
+            self.stage_times[name] = self.stage_times.get(name, 0) + time.perf_counter() - start
+            sampler.stop()
+            self.peak_rss = max(self.peak_rss, sampler.peak_rss)
+            self.peak_worker_rss = max(self.peak_worker_rss, sampler.peak_child_rss)
+
+    def count(self, stage, seconds=0.0, **amounts):
+        """
+        Adds to the telemetry of a stage of the data flow.
+
+        :param str stage: One of TELEMETRY_STAGES.
+        :param float seconds: The time spent in the stage.
+        :param amounts: The bytes, values or points that passed through the stage, like bytes=1024.
+        :return: None
+        :rtype: None
+        """
+        telemetry = self.telemetry[stage]
+        telemetry['seconds'] += seconds
+        for name, amount in amounts.items():
+            telemetry[name] = telemetry.get(name, 0) + amount
+
+    def finish(self):
+        """
+        Marks the run as finished and logs its figures.
+
+        :return: The figures of the run.
+        :rtype: dict
+        """
+        self.finished = time.time()
+        summary = self.to_dict()
+        telemetry = ', '.join(f'{name} {stage["seconds"]:.1f}s' for name, stage in summary['telemetry'].items())
+        logger.info(f'Imported {summary["points"]} points aggregated from {summary["values"]} values of '
+                    f'{summary["files"]} files ({summary["skipped_files"]} unchanged files skipped, '
+                    f'{summary["resumed_files"]} resumed from the journal) in {summary["duration_s"]:.1f}s. '
+                    f'Peak RSS: {summary["peak_rss_bytes"] / 2 ** 20:.1f} MiB (importer), '
+                    f'{summary["peak_worker_rss_bytes"] / 2 ** 20:.1f} MiB (largest parse worker). Stages: '
+                    f'{", ".join(f"{name} {seconds:.1f}s" for name, seconds in summary["stage_times_s"].items())}. '
+                    f'Time spent in {telemetry}. '
+                    f'{summary["failed_batches"]} failed batches.')
+        return summary
+
+    def save(self, summary, path):
+        """
+        Saves the figures of the run as JSON, replacing the report of the previous run atomically.
+
+        :param dict summary: The figures returned by finish().
+        :param str path: The report file.
+        :return: None
+        :rtype: None
+        """
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(summary, f, indent=2)
+        os.replace(f'{path}.tmp', path)
+
+    def to_dict(self):
+        """
+        :return: The figures of the run.
+        :rtype: dict
+        """
+        return {
+            'started': self.started,
+            'duration_s': (self.finished or time.time()) - self.started,
+            'files': self.files,
+            'skipped_files': self.skipped_files,
+            'resumed_files': self.resumed_files,
+            'values': self.values,
+            'points': self.points,
+            'stage_times_s': dict(self.stage_times),
+            'telemetry': {stage: dict(telemetry) for stage, telemetry in self.telemetry.items()},
+            'write_latency_s': latency_percentiles(self.write_latencies),
+            'failed_batches': self.failed_batches,
+            'peak_rss_bytes': self.peak_rss,
+            'peak_worker_rss_bytes': self.peak_worker_rss,
+        }
@@ -0,0 +1,72 @@
+import os
+import signal
+import sys
+import time
+import urllib.error
+
+from config import JOURNAL_FILE_PATH, SCHEDULER_POLL_INTERVAL_S
+from download import archive_changed, archive_identity
+from importer import import_data
+from influx import wait_for_db
+from logging_config import logger
+from util import update_run_state, remove_extracted_data
+
+
+def import_if_changed():
+    """
+    Runs an incremental import if the GSOY archive changed on the server, or if an earlier run was interrupted.
+    The archive is checked with a conditional HEAD request, so a poll of an unchanged archive transfers no data. The
+    state of the importer is recorded in the database before and after the import.
+
+    :return: Whether an import was run.
+    :rtype: bool
+    """
+    # An interrupted run left its journal behind, and resumes without asking the server
+    if not os.path.exists(JOURNAL_FILE_PATH):
+        try:
+            changed = archive_changed()
+        except urllib.error.URLError as e:
+            logger.warning(f'Could not check the GSOY archive for changes, {e}')
+            return False
+        if not changed:
+            logger.info('The GSOY archive did not change since the last import.')
+            return False
+
+    logger.info('Starting import')
+    update_run_state('running')
+    try:
+        remove_extracted_data()
+        summary = import_data()
+    except Exception as e:
+        logger.error(f'Import failed, {e}')
+        update_run_state('failed', error=str(e))
+        return True
+    except BaseException:
+        update_run_state('interrupted')
+        raise
+
+    update_run_state('idle', archive=archive_identity(), points=summary['points'])
+    logger.info('Import finished')
+    return True
+
+
+def run_scheduler(poll_interval=SCHEDULER_POLL_INTERVAL_S):
+    """
+    Keeps the importer resident and imports the GSOY archive whenever it changed, checking every poll_interval
+    seconds. In place of a cron job that starts a cold process for every run, the process, its database client and
+    the loaded mappings stay warm between runs.
+    SIGTERM stops the scheduler. An import that is stopped resumes from its journal when the scheduler starts again.
+
+    :param int poll_interval: The seconds between two checks of the archive.
+    :return: None
+    :rtype: None
+    """
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.info(f'Starting the scheduler, checking the GSOY archive every {poll_interval}s.')
+    wait_for_db()
+    update_run_state('idle')
+
+    while True:
+        started = time.monotonic()
+        import_if_changed()
+        time.sleep(max(0, poll_interval - (time.monotonic() - started)))
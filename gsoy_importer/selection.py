@@ -0,0 +1,124 @@
+from aggregate import MEASUREMENT_INDEX
+from config import FIELD_MAPPING, FIPS_MAPPING
+
+
+class Selection:
+    """
+    Restricts an import to some countries, measurements and years, to repair them after a fix of FIELD_MAPPING or
+    FIPS_MAPPING without a full import.
+
+    Station files of other countries are skipped by their file name prefix without being read, and columns of other
+    measurements are dropped from the column plan by the header of a station file before its rows are parsed. A
+    country is always imported with all of its stations, so its aggregates are complete.
+    """
+
+    def __init__(self, countries=None, measurements=None, years=None):
+        """
+        :param countries: The FIPS codes of the countries, or None for all countries.
+        :type countries: set[str] or None
+        :param measurements: The indices of the measurements in aggregate.MEASUREMENTS, or None for all measurements.
+        :type measurements: set[int] or None
+        :param years: The first and last year, or None for all years.
+        :type years: tuple[int, int] or None
+        """
+        self.countries = countries
+        self.measurements = measurements
+        self.years = years
+
+    @classmethod
+    def parse(cls, countries=None, measurements=None, years=None):
+        """
+        Parses the selection given on the command line.
+
+        :param countries: Comma separated ISO or 'FIPS:<code>' country codes.
+        :type countries: str or None
+        :param measurements: Comma separated measurement names or GSOY element codes, like 'Average_Temperature' or
+         'TAVG'.
+        :type measurements: str or None
+        :param years: A year, or a year range like '1950-2000'.
+        :type years: str or None
+        :return: The selection.
+        :rtype: Selection
+        :raises ValueError: If a country, measurement or year range is unknown or malformed.
+        """
+        return cls(
+            parse_countries(countries) if countries else None,
+            parse_measurements(measurements) if measurements else None,
+            parse_years(years) if years else None,
+        )
+
+    def __str__(self):
+        countries = ','.join(sorted(self.countries)) if self.countries is not None else 'all'
+        measurements = ','.join(map(str, sorted(self.measurements))) if self.measurements is not None else 'all'
+        years = '-'.join(map(str, self.years)) if self.years is not None else 'all'
+        return f'countries={countries} measurements={measurements} years={years}'
+
+    def owns(self, filename):
+        """
+        Checks by its file name whether a station file is selected.
+
+        :param str filename: The name of the station file.
+        :return: Whether the station file is of a selected country.
+        :rtype: bool
+        """
+        return self.countries is None or filename[:2] in self.countries
+
+
+def parse_countries(countries):
+    """
+    Resolves country codes to FIPS codes.
+    Codes are ISO codes, like the country_iso tag, and select all FIPS codes that map to them. FIPS codes are given as
+    'FIPS:<code>', since many two letter codes are valid in both systems for different countries.
+
+    :param str countries: Comma separated ISO or 'FIPS:<code>' country codes.
+    :return: The FIPS codes.
+    :rtype: set[str]
+    :raises ValueError: If a country code is unknown.
+    """
+    fips_codes = set()
+    for code in countries.split(','):
+        code = code.strip().upper()
+        if code.startswith('FIPS:'):
+            matches = {code[5:]} & FIPS_MAPPING.keys()
+        else:
+            matches = {fips for fips, country in FIPS_MAPPING.items() if country['country_iso'] == code}
+        if not matches:
+            raise ValueError(f'Unknown country "{code}".')
+        fips_codes |= matches
+    return fips_codes
+
+
+def parse_measurements(measurements):
+    """
+    Resolves measurement names or GSOY element codes to their indices in aggregate.MEASUREMENTS.
+
+    :param str measurements: Comma separated measurement names or GSOY element codes.
+    :return: The measurement indices.
+    :rtype: set[int]
+    :raises ValueError: If a measurement is not in FIELD_MAPPING.
+    """
+    indices = set()
+    for measurement in measurements.split(','):
+        measurement = measurement.strip()
+        if measurement in FIELD_MAPPING:
+            measurement = FIELD_MAPPING[measurement].get('name', measurement)
+        if measurement not in MEASUREMENT_INDEX:
+            raise ValueError(f'Unknown measurement "{measurement}".')
+        indices.add(MEASUREMENT_INDEX[measurement])
+    return indices
+
+
+def parse_years(years):
+    """
+    Parses a year or a year range.
+
+    :param str years: A year, or a year range like '1950-2000'.
+    :return: The first and last year.
+    :rtype: tuple[int, int]
+    :raises ValueError: If the years are malformed or the range is empty.
+    """
+    first, _, last = years.partition('-')
+    first, last = int(first), int(last or first)
+    if first > last:
+        raise ValueError(f'The year range {years} is empty.')
+    return first, last
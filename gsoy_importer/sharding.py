@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import zlib
+
+import numpy as np
+
+from aggregate import CountryAggregator
+from config import FIPS_MAPPING, SHARD_DIR
+from logging_config import logger
+
+SHARD_BY = ('country', 'station')
+
+
+class Shard:
+    """
+    One of several importer processes that split the station files of an archive between them, by a stable hash of the
+    ISO country code or of the station file name.
+
+    Sharding by country keeps all stations of a country in one shard, including those of all FIPS codes that map to
+    the country, so every shard aggregates and writes its own countries. Sharding by station spreads large countries
+    across shards, so the shards save their partial aggregates to the shared SHARD_DIR and the coordinator merges and
+    writes them.
+
+    The shards of a run meet in a directory of SHARD_DIR named after the archive version and the shard spec. Each shard
+    leaves a marker there when it has finished, and the shard that finds all markers present becomes the coordinator,
+    which runs the steps that need all shards, like merging the partial aggregates and update_last_run(). SHARD_DIR
+    must therefore be shared by all importer nodes, for example through a network volume.
+    """
+
+    def __init__(self, index, count, by='country'):
+        if not 1 <= index <= count:
+            raise ValueError(f'Shard {index} is not within 1 to {count}.')
+        if by not in SHARD_BY:
+            raise ValueError(f'Cannot shard by "{by}", expected one of {", ".join(SHARD_BY)}.')
+        self.index = index
+        self.count = count
+        self.by = by
+
+    @classmethod
+    def parse(cls, spec, by='country'):
+        """
+        Parses a shard spec.
+
+        :param str spec: The spec 'i/N' of shard i of N, counting from 1.
+        :param str by: 'country' or 'station'.
+        :return: The shard.
+        :rtype: Shard
+        """
+        index, _, count = spec.partition('/')
+        return cls(int(index), int(count), by)
+
+    @property
+    def name(self):
+        """
+        :return: The name of the shard, like 'shard-1-of-4'.
+        :rtype: str
+        """
+        return f'shard-{self.index}-of-{self.count}'
+
+    def owns(self, filename):
+        """
+        Checks whether a station file belongs to this shard.
+
+        :param str filename: The name of the station file.
+        :return: Whether the station file belongs to this shard.
+        :rtype: bool
+        """
+        if self.by == 'country':
+            # Unmapped FIPS codes, whose stations are not aggregated, are spread by their own code
+            key = FIPS_MAPPING.get(filename[:2], {}).get('country_iso', filename[:2])
+        else:
+            key = filename
+        return zlib.crc32(key.encode()) % self.count == self.index - 1
+
+    def local_path(self, path):
+        """
+        Gets the path of a local state file of this shard, like its manifest, fingerprints or journal.
+
+        :param str path: The path of the state file of an unsharded import.
+        :return: The path of the state file in a directory of this shard.
+        :rtype: str
+        """
+        return os.path.join(os.path.dirname(path), self.name, os.path.basename(path))
+
+    def run_dir(self, identity):
+        """
+        Gets the shared directory where the shards of a run meet.
+
+        :param str identity: The identity of the archive of the run.
+        :return: The directory.
+        :rtype: str
+        """
+        run = hashlib.blake2b(f'{identity}|{self.count}|{self.by}'.encode(), digest_size=8).hexdigest()
+        return os.path.join(SHARD_DIR, run)
+
+    def finish(self, identity, aggregator=None):
+        """
+        Marks this shard as finished, and checks whether it is the coordinator of the run.
+        The partial aggregate of a shard by station is saved before the marker, so that the coordinator finds it.
+
+        :param str identity: The identity of the archive of the run.
+        :param aggregator: The partial aggregate of a shard by station.
+        :type aggregator: CountryAggregator or None
+        :return: Whether this shard is the coordinator, which runs the final steps of the run.
+        :rtype: bool
+        """
+        run_dir = self.run_dir(identity)
+        os.makedirs(run_dir, exist_ok=True)
+
+        if aggregator is not None:
+            state = aggregator.state()
+            with open(os.path.join(run_dir, f'{self.name}.npz.tmp'), 'wb') as f:
+                np.savez(f, **state)
+            os.replace(os.path.join(run_dir, f'{self.name}.npz.tmp'), os.path.join(run_dir, f'{self.name}.npz'))
+
+        open(os.path.join(run_dir, f'{self.name}.done'), 'w').close()
+        finished = sum(1 for file_name in os.listdir(run_dir) if file_name.endswith('.done'))
+        if finished < self.count:
+            logger.info(f'{self.name} finished, waiting for {self.count - finished} more shards.')
+            return False
+
+        # Every shard that finishes after the others sees all markers, the lock file elects one of them
+        lock_path = os.path.join(run_dir, 'coordinator')
+        try:
+            fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # A coordinator that was interrupted resumes its role
+            with open(lock_path, 'r') as f:
+                return f.read() == self.name
+        with os.fdopen(fd, 'w') as f:
+            f.write(self.name)
+        logger.info(f'All {self.count} shards finished, {self.name} coordinates the run.')
+        return True
+
+    def merge(self, identity):
+        """
+        Merges the partial aggregates of all shards by station. Only called by the coordinator.
+
+        :param str identity: The identity of the archive of the run.
+        :return: The merged aggregate.
+        :rtype: CountryAggregator
+        """
+        run_dir = self.run_dir(identity)
+        aggregator = CountryAggregator()
+        for index in range(1, self.count + 1):
+            with np.load(os.path.join(run_dir, f'shard-{index}-of-{self.count}.npz')) as state:
+                aggregator.merge(CountryAggregator.from_state({key: state[key] for key in state.files}))
+        return aggregator
+
+    def clear(self, identity):
+        """
+        Removes the shared directory of a finished run. Only called by the coordinator.
+
+        :param str identity: The identity of the archive of the run.
+        :return: None
+        :rtype: None
+        """
+        shutil.rmtree(self.run_dir(identity), ignore_errors=True)
@@ -0,0 +1,224 @@
+import os
+
+import numpy as np
+
+from aggregate import COUNTRIES, MEASUREMENTS, RECORD_DTYPE
+from config import SNAPSHOT_FILE_PATH
+from logging_config import logger
+
+
+class NullSink:
+    """
+    A sink that counts the line protocol it receives and discards it, to measure the importer without a database.
+
+    Sinks take the output of the write phase in place of the BatchWriter, and share its put_records(), write(), flush()
+    and close() methods and its written_points, failed_batches, failed_keys and latencies figures. put_records()
+    receives the aggregated records of the run once, before they are encoded, and write() receives the encoded batches.
+    """
+
+    def __init__(self):
+        self.written_points = 0
+        self.failed_batches = 0
+        self.failed_keys = []
+        self.latencies = []
+
+    def put_records(self, records, countries=None, measurements=None, years=None):
+        """
+        Receives the aggregated records of the run.
+        An incremental or selective run only aggregates some countries, measurements and years again, which are given
+        by the scope arguments, and whose earlier records are replaced by the records of the run.
+
+        :param numpy.ndarray records: The records, in aggregate.RECORD_DTYPE.
+        :param countries: The indices in aggregate.COUNTRIES of the countries aggregated again, or None for all.
+        :type countries: set[int] or None
+        :param measurements: The indices in aggregate.MEASUREMENTS of the measurements aggregated again, or None for
+         all.
+        :type measurements: set[int] or None
+        :param years: The first and last year aggregated again, or None for all.
+        :type years: tuple[int, int] or None
+        :return: None
+        :rtype: None
+        """
+
+    def write(self, batch):
+        """
+        Receives line protocol.
+
+        :param bytes batch: Newline terminated line protocol.
+        :return: None
+        :rtype: None
+        """
+        self.written_points += batch.count(b'\n')
+
+    def flush(self):
+        """
+        Waits for the received line protocol to be stored. Nothing to wait for.
+
+        :return: None
+        :rtype: None
+        """
+
+    def close(self):
+        """
+        Closes the sink.
+
+        :return: None
+        :rtype: None
+        """
+
+
+class MemorySink(NullSink):
+    """
+    A sink that keeps the line protocol it receives in memory, to inspect what an import would write.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def write(self, batch):
+        super().write(batch)
+        self.batches.append(batch)
+
+    def lines(self):
+        """
+        :return: The received points, as lines of line protocol.
+        :rtype: list[bytes]
+        """
+        return b''.join(self.batches).splitlines()
+
+
+class SnapshotSink(NullSink):
+    """
+    A sink that keeps all aggregated records in a local columnar snapshot file, to rebuild the database or seed other
+    services from it without parsing the archive again.
+
+    The snapshot is a NumPy .npz file with one array per column of aggregate.RECORD_DTYPE, sorted by country,
+    measurement and year, along with the country ISO codes and measurement names that the indices of the country and
+    measurement columns refer to. The records of an incremental or selective run replace the records of their scope in
+    the existing snapshot, and the snapshot is replaced atomically when the sink is closed.
+    """
+
+    def __init__(self, path=SNAPSHOT_FILE_PATH):
+        super().__init__()
+        self.path = path
+        self._records = None
+
+    def put_records(self, records, countries=None, measurements=None, years=None):
+        kept = load_snapshot(self.path) if os.path.exists(self.path) else np.empty(0, dtype=RECORD_DTYPE)
+        replaced = np.ones(len(kept), dtype=bool)
+        if countries is not None:
+            replaced &= np.isin(kept['country'], list(countries))
+        if measurements is not None:
+            replaced &= np.isin(kept['measurement'], list(measurements))
+        if years is not None:
+            replaced &= (kept['year'] >= years[0]) & (kept['year'] <= years[1])
+
+        merged = np.concatenate([kept[~replaced], records])
+        self._records = merged[np.lexsort((merged['year'], merged['measurement'], merged['country']))]
+
+    def close(self):
+        if self._records is None:
+            return
+        save_snapshot(self._records, self.path)
+        logger.info(f'Saved {len(self._records)} records to the snapshot {self.path}.')
+        self._records = None
+
+
+class FanOutSink:
+    """
+    A sink that feeds several sinks from the same run, like the BatchWriter and a SnapshotSink.
+    Its written_points are the points that reached all sinks, and its failed_batches, failed_keys and latencies
+    those of all sinks.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    @property
+    def written_points(self):
+        return min(sink.written_points for sink in self.sinks)
+
+    @property
+    def failed_batches(self):
+        return sum(sink.failed_batches for sink in self.sinks)
+
+    @property
+    def failed_keys(self):
+        return [keys for sink in self.sinks for keys in sink.failed_keys]
+
+    @property
+    def latencies(self):
+        return [latency for sink in self.sinks for latency in sink.latencies]
+
+    def put_records(self, records, countries=None, measurements=None, years=None):
+        for sink in self.sinks:
+            sink.put_records(records, countries, measurements, years)
+
+    def write(self, batch):
+        for sink in self.sinks:
+            sink.write(batch)
+
+    def flush(self):
+        for sink in self.sinks:
+            sink.flush()
+
+    def close(self):
+        """
+        Closes all sinks, even if closing one of them fails.
+
+        :return: None
+        :rtype: None
+        """
+        errors = []
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.error(f'Failed to close {type(sink).__name__}, {e}')
+                errors.append(e)
+        if errors:
+            raise errors[0]
+
+
+def save_snapshot(records, path=SNAPSHOT_FILE_PATH):
+    """
+    Saves records as a columnar snapshot, replacing the previous snapshot atomically.
+
+    :param numpy.ndarray records: The records, in aggregate.RECORD_DTYPE.
+    :param str path: The snapshot file.
+    :return: None
+    :rtype: None
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    columns = {name: records[name] for name in RECORD_DTYPE.names}
+    with open(f'{path}.tmp', 'wb') as f:
+        np.savez(f, countries=np.array(COUNTRIES), measurements=np.array(MEASUREMENTS), **columns)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_snapshot(path=SNAPSHOT_FILE_PATH):
+    """
+    Loads the records of a columnar snapshot.
+    The country and measurement columns are mapped to the current aggregate.COUNTRIES and aggregate.MEASUREMENTS, and
+    records of countries or measurements that are no longer mapped are dropped.
+
+    :param str path: The snapshot file.
+    :return: The records, in aggregate.RECORD_DTYPE.
+    :rtype: numpy.ndarray
+    """
+    with np.load(path) as snapshot:
+        records = np.empty(len(snapshot['year']), dtype=RECORD_DTYPE)
+        for name in RECORD_DTYPE.names:
+            records[name] = snapshot[name]
+        countries, measurements = snapshot['countries'].tolist(), snapshot['measurements'].tolist()
+
+    # -1 marks the countries and measurements of the snapshot that are not mapped anymore
+    country_map = np.array([COUNTRIES.index(code) if code in COUNTRIES else -1 for code in countries] or [-1])
+    measurement_map = np.array([MEASUREMENTS.index(name) if name in MEASUREMENTS else -1 for name in measurements]
+                               or [-1])
+    country, measurement = country_map[records['country']], measurement_map[records['measurement']]
+    mapped = (country >= 0) & (measurement >= 0)
+    records = records[mapped]
+    records['country'], records['measurement'] = country[mapped], measurement[mapped]
+    return records
@@ -0,0 +1,135 @@
+import csv
+import io
+import random
+import tarfile
+
+import numpy as np
+
+from aggregate import RECORD_DTYPE, MEASUREMENTS, COUNTRIES
+from config import FIPS_MAPPING
+
+GSOY_STATION_COLUMNS = ['STATION', 'DATE', 'LATITUDE', 'LONGITUDE', 'ELEVATION', 'NAME']
+
+# The elements of the GSOY archive, in the order they appear in the station files
+GSOY_ELEMENTS = (
+        ['AWND', 'CDSD', 'CLDD', 'DP01', 'DP05', 'DP10', 'DP1X', 'DSND', 'DSNW', 'DT00', 'DT32', 'DX32', 'DX70', 'DX90',
+         'DYFG', 'DYHF', 'DYNT', 'DYSD', 'DYSN', 'DYTS', 'DYXP', 'DYXT', 'EMNT', 'EMSD', 'EMSN', 'EMXP', 'EMXT', 'EVAP']
+        + [f'FZF{i}' for i in range(10)]
+        + ['HDSD']
+        + [f'{prefix}0{depth}' for prefix in ('HN', 'HX', 'LN', 'LX', 'MN', 'MX') for depth in '123456789']
+        + ['HTDD', 'MNPN', 'MXPN', 'PRCP', 'PSUN', 'SNOW', 'TAVG', 'TMAX', 'TMIN', 'TSUN', 'WDF1', 'WDF2', 'WDF5',
+           'WDFG', 'WDFI', 'WDFM', 'WDMV', 'WSF1', 'WSF2', 'WSF5', 'WSFG', 'WSFI', 'WSFM']
+)
+
+
+def station_header(elements=GSOY_ELEMENTS):
+    """
+    Builds the header row of a GSOY station file, with an attributes column after every element.
+
+    :param list[str] elements: The elements reported by the station.
+    :return: The header row.
+    :rtype: list[str]
+    """
+    header = list(GSOY_STATION_COLUMNS)
+    for element in elements:
+        header += [element, f'{element}_ATTRIBUTES']
+    return header
+
+
+def _attributes(element, year, rng):
+    if element.startswith('EM'):
+        return f',W,{year}{rng.randint(1, 12):02d}{rng.randint(1, 28):02d},{rng.choice(["", "+"])}'
+    if element.startswith('D'):
+        return f'{rng.randint(0, 3)},W'
+    return ',W'
+
+
+def station_csv(station, first_year=1900, num_years=120, elements=GSOY_ELEMENTS, empty_ratio=0.3, seed=None):
+    """
+    Generates a synthetic GSOY station file.
+    Every element cell is left empty with probability empty_ratio, like the sparse columns of the real archive.
+
+    :param str station: The station id. Its first two letters are the FIPS country code.
+    :param int first_year: The first year of the station record.
+    :param int num_years: The number of yearly rows.
+    :param list[str] elements: The elements reported by the station.
+    :param float empty_ratio: The share of empty element cells.
+    :param seed: The seed of the random values. Defaults to the station id.
+    :return: The contents of the station file.
+    :rtype: bytes
+    """
+    rng = random.Random(seed if seed is not None else station)
+    latitude, longitude = f'{rng.uniform(-90, 90):.4f}', f'{rng.uniform(-180, 180):.4f}'
+    elevation, name = f'{rng.uniform(0, 3000):.1f}', f'SYNTHETIC STATION {station}, {station[:2]}'
+
+    output = io.StringIO()
+    writer = csv.writer(output, quoting=csv.QUOTE_ALL, lineterminator='\n')
+    writer.writerow(station_header(elements))
+
+    for year in range(first_year, first_year + num_years):
+        row = [station, str(year), latitude, longitude, elevation, name]
+        for element in elements:
+            if rng.random() < empty_ratio:
+                row += ['', '']
+            else:
+                row += [f'{rng.uniform(-40, 400):.2f}', _attributes(element, year, rng)]
+        writer.writerow(row)
+
+    return output.getvalue().encode('utf-8')
+
+
+def synthetic_archive(file_name, num_stations=100, first_year=1900, num_years=120, elements=GSOY_ELEMENTS,
+                      empty_ratio=0.3, num_countries=50, seed=0):
+    """
+    Generates a synthetic gsoy-latest.tar.gz archive of station files.
+    The stations are spread over the first num_countries FIPS codes of FIPS_MAPPING, with station ids shaped like the
+    real ones: the FIPS code, a network code and eight digits.
+
+    :param str file_name: The archive file to write.
+    :param int num_stations: The number of station files.
+    :param int first_year: The first year of every station record.
+    :param int num_years: The number of yearly rows of every station file.
+    :param list[str] elements: The elements reported by the stations.
+    :param float empty_ratio: The share of empty element cells.
+    :param int num_countries: The number of countries.
+    :param int seed: The seed of the random values.
+    :return: The number of rows of all station files.
+    :rtype: int
+    """
+    fips_codes = sorted(FIPS_MAPPING)[:num_countries]
+    with tarfile.open(file_name, 'w:gz') as tar:
+        for index in range(num_stations):
+            station = f'{fips_codes[index % len(fips_codes)]}W{index:08d}'
+            data = station_csv(station, first_year, num_years, elements, empty_ratio, seed=f'{seed}-{station}')
+            member = tarfile.TarInfo(f'{station}.csv')
+            member.size = len(data)
+            member.mtime = 1700000000
+            tar.addfile(member, io.BytesIO(data))
+    return num_stations * num_years
+
+
+def synthetic_records(num_countries=50, first_year=1900, num_years=120, seed=0):
+    """
+    Generates synthetic aggregated records, one per country, measurement and year, in station order: country by
+    country, year by year and measurement by measurement, like the rows and columns of the station files.
+
+    :param int num_countries: The number of countries, taken from aggregate.COUNTRIES.
+    :param int first_year: The first year.
+    :param int num_years: The number of years.
+    :param int seed: The seed of the random values.
+    :return: The records, in aggregate.RECORD_DTYPE.
+    :rtype: numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    countries, years, measurements = np.meshgrid(np.arange(min(num_countries, len(COUNTRIES))),
+                                                 np.arange(first_year, first_year + num_years),
+                                                 np.arange(len(MEASUREMENTS)), indexing='ij')
+    records = np.empty(countries.size, dtype=RECORD_DTYPE)
+    records['country'] = countries.ravel()
+    records['measurement'] = measurements.ravel()
+    records['year'] = years.ravel()
+    records['min'] = rng.uniform(-40, 0, len(records))
+    records['max'] = rng.uniform(20, 400, len(records))
+    records['value'] = (records['min'] + records['max']) / 2
+    records['station_count'] = rng.integers(1, 500, len(records))
+    return records
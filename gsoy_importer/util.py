@@ -1,7 +1,8 @@
+import hashlib
+import json
 import os
 import shutil
 import tarfile
-import urllib.request
 from datetime import datetime, timedelta, timezone
 
 
@@ -45,10 +46,83 @@ def ms_to_timestamp(timestamp_ms):
     return timestamp.replace(tzinfo=timezone.utc)
 
 
-def update_last_run():
+def load_manifest(path=None):
+    """
+    Loads the manifest of the station files imported by the last run.
+
+    :param path: The manifest file, MANIFEST_FILE_PATH by default.
+    :type path: str or None
+    :return: The station file name -> {'size', 'mtime', 'hash'} entries, or an empty dict if there is no manifest.
+    :rtype: dict[str, dict]
+    """
+    from logging_config import logger
+    from config import MANIFEST_FILE_PATH
+
+    path = path or MANIFEST_FILE_PATH
+    if not os.path.exists(path):
+        logger.info('No manifest found. All station files will be imported.')
+        return {}
+
+    with open(path, "r") as f:
+        manifest = json.load(f)
+
+    logger.info(f'Found manifest of {len(manifest)} station files.')
+    return manifest
+
+
+def save_manifest(manifest, path=None):
+    """
+    Saves the manifest of the imported station files, replacing the previous one atomically.
+
+    :param dict[str, dict] manifest: The station file name -> {'size', 'mtime', 'hash'} entries.
+    :param path: The manifest file, MANIFEST_FILE_PATH by default.
+    :type path: str or None
+    :return: None
+    :rtype: None
+    """
+    from config import MANIFEST_FILE_PATH
+
+    path = path or MANIFEST_FILE_PATH
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    with open(f'{path}.tmp', "w") as f:
+        json.dump(manifest, f)
+    os.replace(f'{path}.tmp', path)
+
+
+def manifest_entry(member, data):
+    """
+    Builds the manifest entry of a station file from its tar header and contents.
+
+    :param tarfile.TarInfo member: The tar header of the station file.
+    :param bytes data: The contents of the station file.
+    :return: The manifest entry.
+    :rtype: dict
+    """
+    return {'size': member.size, 'mtime': member.mtime, 'hash': hashlib.blake2b(data, digest_size=16).hexdigest()}
+
+
+def is_unchanged(member, previous_entry):
+    """
+    Checks from the tar header alone whether a station file is unchanged since the last run.
+
+    :param tarfile.TarInfo member: The tar header of the station file.
+    :param previous_entry: The manifest entry of the station file from the last run, if any.
+    :type previous_entry: dict or None
+    :return: Whether the size and modification time match the manifest entry.
+    :rtype: bool
+    """
+    return previous_entry is not None and previous_entry['size'] == member.size \
+        and previous_entry['mtime'] == member.mtime
+
+
+def update_last_run(manifest=None):
     """
     Records the current time as the 'last run' time in a file and the database.
+    If given, the manifest of the imported station files is saved along with it.
 
+    :param manifest: The station file name -> {'size', 'mtime', 'hash'} entries of this run.
+    :type manifest: dict[str, dict] or None
     :return: None
     :rtype: None
     """
@@ -56,6 +130,9 @@ def update_last_run():
     from influx import write_points_to_db
     from config import LAST_RUN_LAST_RUN_FILE_PATH
 
+    if manifest is not None:
+        save_manifest(manifest)
+
     current_time = datetime.now()
 
     last_run_point = [
@@ -79,70 +156,138 @@ def update_last_run():
         f.write(current_time.strftime("%Y-%m-%d %H:%M:%S"))
 
 
-def extract_tar_file(file_name):
+def update_run_state(state, **fields):
     """
-    Extracts the tar file to the 'extracted_data' directory within the target directory.
+    Records the state of the importer in the database, so that the API can tell whether an import is running and
+    invalidate its caches once an import has finished.
 
-    :param file_name: Name of the tar file to extract.
-    :type file_name: str
+    :param str state: 'running', 'idle', 'failed' or 'interrupted'.
+    :param fields: Further fields of the state, like the identity of the imported archive.
     :return: None
     :rtype: None
     """
-    from config import GSOY_DATA_DIR
-    from logging_config import logger
 
-    extracted_data_dir = os.path.join(GSOY_DATA_DIR, 'extracted_data')
-    os.makedirs(extracted_data_dir, exist_ok=True)
+    from influx import write_points_to_db
 
-    tar = tarfile.open(file_name, 'r:gz')
-    logger.info('Extracting tar file...')
-    tar.extractall(extracted_data_dir)
-    tar.close()
-    logger.info('Tar file extracted successfully.')
+    current_time = datetime.now()
 
+    write_points_to_db([
+        {
+            "measurement": "metadata",
+            "tags": {
+                "script": "gsoy_importer"
+            },
+            "time": current_time,
+            "fields": {
+                "run_state": state,
+                "run_state_since": current_time.isoformat(),
+                **fields
+            }
+        }
+    ])
 
-def download_and_extract_data():
+
+def update_data_version(reason):
     """
-    Downloads and extracts the data from the given URL to the target directory.
-    If the tar file already exists and was downloaded within the last 29 days, it will be extracted without re-downloading.
+    Records the current time as the 'data_version' in the database, for runs that rewrite data without changing the
+    'last run' time, like selective repairs and snapshot restores, so that the API drops its cached responses.
 
+    :param str reason: What rewrote the data, like 'selective import' or 'snapshot restore'.
     :return: None
     :rtype: None
     """
-    from config import GSOY_DATA_DIR
-    from logging_config import logger
-    from config import GSOY_DOWNLOAD_URL
 
-    os.makedirs(GSOY_DATA_DIR, exist_ok=True)
+    from influx import write_points_to_db
 
-    file_name = os.path.join(GSOY_DATA_DIR, 'gsoy-latest.tar.gz')
+    current_time = datetime.now()
 
-    if os.path.exists(file_name):
-        modified_time = datetime.fromtimestamp(os.path.getmtime(file_name))
-        current_time = datetime.now()
-        time_diff = current_time - modified_time
+    write_points_to_db([
+        {
+            "measurement": "metadata",
+            "tags": {
+                "script": "gsoy_importer"
+            },
+            "time": current_time,
+            "fields": {
+                "data_version": current_time.isoformat(),
+                "data_version_reason": reason
+            }
+        }
+    ])
 
-        if time_diff <= timedelta(days=15):
-            logger.info('The tar file already exists and was downloaded within the last 15 days. Skipping download.')
-            if os.path.exists(os.path.join(GSOY_DATA_DIR, 'extracted_data')):
-                logger.info('Extracted data already exists. Skipping extraction.')
-            else:
-                extract_tar_file(file_name)
-            return
-        else:
-            logger.info('The tar file already exists but was downloaded more than 15 days ago. Downloading again.')
-            os.remove(file_name)
 
-    logger.info('Downloading tar file...')
-    urllib.request.urlretrieve(GSOY_DOWNLOAD_URL, file_name)
-    logger.info('Tar file downloaded successfully.')
+def record_run_summary(summary, shard=None):
+    """
+    Writes the figures of an import run to the database, as a 'metadata' point next to the 'last run' point.
+
+    :param dict summary: The figures returned by RunReport.finish().
+    :param shard: The name of the shard of the run, if sharded.
+    :type shard: str or None
+    :return: None
+    :rtype: None
+    """
+
+    from influx import write_points_to_db
+
+    tags = {"script": "gsoy_importer"}
+    if shard is not None:
+        tags["shard"] = shard
+
+    fields = {
+        "run_duration_s": float(summary["duration_s"]),
+        "run_files": summary["files"],
+        "run_skipped_files": summary["skipped_files"],
+        "run_values": summary["values"],
+        "run_points": summary["points"],
+        "run_failed_batches": summary["failed_batches"],
+        "run_peak_rss_bytes": summary["peak_rss_bytes"],
+        "run_peak_worker_rss_bytes": summary["peak_worker_rss_bytes"],
+    }
+    for stage, telemetry in summary["telemetry"].items():
+        fields[f"run_{stage}_s"] = float(telemetry["seconds"])
+        for name, amount in telemetry.items():
+            if name != "seconds":
+                fields[f"run_{stage}_{name}"] = amount
+    for percentile, latency in summary["write_latency_s"].items():
+        fields[f"run_write_latency_{percentile}_s"] = float(latency)
+
+    write_points_to_db([
+        {
+            "measurement": "metadata",
+            "tags": tags,
+            "time": datetime.now(),
+            "fields": fields
+        }
+    ])
+
+
+def iter_station_files(archive):
+    """
+    Iterates over the station CSV files of the GSOY tar archive without extracting it to disk.
+    The archive is read as a stream, so each yielded file object is only valid until the next one is requested.
+
+    :param archive: The binary file object of the gzipped tar archive.
+    :return: A generator of (station file name, tar header, binary file object) tuples.
+    :rtype: Iterator[tuple[str, tarfile.TarInfo, io.BufferedReader]]
+    """
+    from logging_config import logger
+
+    logger.info('Streaming station files from tar file...')
+    with tarfile.open(fileobj=archive, mode='r|gz') as tar:
+        for member in tar:
+            if not member.isfile() or not member.name.endswith('.csv'):
+                continue
+            yield os.path.basename(member.name), member, tar.extractfile(member)
 
-    extract_tar_file(file_name)
+    # Consume the padding after the end-of-archive marker, so that a download in progress runs to completion
+    while archive.read(1024 * 1024):
+        pass
+    logger.info('Tar file streamed successfully.')
 
 
 def remove_extracted_data():
     """
-    Removes the previously extracted data directory from the target directory.
+    Removes a data directory left behind by importer versions that extracted the tar file to disk.
 
     :return: None
     :rtype: None
@@ -155,5 +300,3 @@ def remove_extracted_data():
     if os.path.exists(extracted_data_dir):
         shutil.rmtree(extracted_data_dir)
         logger.info('Extracted data removed successfully.')
-    else:
-        logger.info('No extracted data found.')
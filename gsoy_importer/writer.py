@@ -0,0 +1,218 @@
+import concurrent.futures
+import os
+import random
+import threading
+import time
+import uuid
+
+from influxdb_client import WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+from config import BUCKET, BATCH_SIZE, MIN_BATCH_SIZE, MAX_BATCH_SIZE, REJECTED_DIR, SPOOL_DIR, WRITE_MAX_IN_FLIGHT, \
+    WRITE_RETRIES, WRITE_RETRY_DELAY_S, WRITE_TARGET_LATENCY_S
+from fingerprints import batch_keys
+from influx import client
+from logging_config import logger
+
+# Client errors that a retry cannot fix
+NON_RETRYABLE_STATUSES = {400, 401, 403, 404, 422}
+
+
+def is_rejection(error):
+    """
+    Checks whether a write failed because the database rejected the batch, which a retry cannot fix.
+
+    :param Exception error: The error of the write.
+    :return: Whether the database rejected the batch.
+    :rtype: bool
+    """
+    return getattr(error, 'status', None) in NON_RETRYABLE_STATUSES
+
+
+def _nth_newline(buffer, n):
+    position = -1
+    for _ in range(n):
+        position = buffer.index(b'\n', position + 1)
+    return position + 1
+
+
+class BatchWriter:
+    """
+    Writes line protocol to the database with several requests in flight.
+
+    Incoming batches are re-cut into write requests of batch_size points. The batch size adapts to the observed write
+    latency: it is halved when a request takes longer than WRITE_TARGET_LATENCY_S and grows again while requests are
+    fast. Failed requests are retried with exponential backoff, and requests that still fail are spooled to SPOOL_DIR so
+    that replay_spool() can send them on the next run. Requests that the database rejects with a status that a retry
+    cannot fix are neither retried nor spooled, but quarantined to REJECTED_DIR for inspection.
+    The key hashes of the points of failed requests are kept in failed_keys, so that their fingerprints are not
+    recorded as written.
+    """
+
+    def __init__(self, max_in_flight=WRITE_MAX_IN_FLIGHT, spool_dir=SPOOL_DIR, rejected_dir=REJECTED_DIR):
+        self.batch_size = BATCH_SIZE
+        self.spool_dir = spool_dir
+        self.rejected_dir = rejected_dir
+        self.written_points = 0
+        self.failed_batches = 0
+        self.rejected_batches = 0
+        self.failed_keys = []
+        self.latencies = []
+        self._max_in_flight = max_in_flight
+        self._write_api = client.write_api(write_options=SYNCHRONOUS)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight)
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._pending = bytearray()
+        self._pending_points = 0
+
+    def write(self, batch):
+        """
+        Adds line protocol to the writer. Blocks while max_in_flight requests are in flight.
+
+        :param bytes batch: Newline terminated line protocol.
+        :return: None
+        :rtype: None
+        """
+        self._pending += batch
+        self._pending_points += batch.count(b'\n')
+
+        while self._pending_points >= self.batch_size:
+            num_points = self.batch_size
+            end = _nth_newline(self._pending, num_points)
+            self._submit(bytes(self._pending[:end]), num_points)
+            del self._pending[:end]
+            self._pending_points -= num_points
+
+    def put_records(self, records, countries=None, measurements=None, years=None):
+        """
+        Receives the aggregated records of the run. The database is written from the line protocol only.
+
+        :param numpy.ndarray records: The records, in aggregate.RECORD_DTYPE.
+        :return: None
+        :rtype: None
+        """
+
+    def flush(self):
+        """
+        Sends the remaining line protocol and waits for all requests in flight to finish, either written or spooled.
+
+        :return: None
+        :rtype: None
+        """
+        if self._pending_points:
+            self._submit(bytes(self._pending), self._pending_points)
+            self._pending.clear()
+            self._pending_points = 0
+        for _ in range(self._max_in_flight):
+            self._in_flight.acquire()
+        for _ in range(self._max_in_flight):
+            self._in_flight.release()
+
+    def close(self):
+        """
+        Sends the remaining line protocol and waits for all requests to finish.
+
+        :return: None
+        :rtype: None
+        """
+        self.flush()
+        self._executor.shutdown(wait=True)
+        self._write_api.close()
+        logger.info(f'Wrote {self.written_points} points to db, {self.failed_batches - self.rejected_batches} batches '
+                    f'failed and were spooled, {self.rejected_batches} were rejected and quarantined.')
+
+    def replay_spool(self):
+        """
+        Sends the batches that were spooled by previous runs. Batches that fail again stay in the spool, and batches
+        that the database rejects are quarantined.
+
+        :return: The number of batches that were replayed.
+        :rtype: int
+        """
+        if not os.path.isdir(self.spool_dir):
+            return 0
+
+        replayed = 0
+        for spool_file in sorted(os.listdir(self.spool_dir)):
+            if not spool_file.endswith('.lp'):
+                continue
+            spool_path = os.path.join(self.spool_dir, spool_file)
+            with open(spool_path, 'rb') as f:
+                batch = f.read()
+            try:
+                self._send(batch)
+            except Exception as e:
+                if is_rejection(e):
+                    logger.error(f'The database rejected the spooled batch {spool_file}, quarantining it. {e}')
+                    os.makedirs(self.rejected_dir, exist_ok=True)
+                    os.replace(spool_path, os.path.join(self.rejected_dir, spool_file))
+                else:
+                    logger.error(f'Failed to replay spooled batch {spool_file}, {e}')
+                continue
+            os.remove(spool_path)
+            self.written_points += batch.count(b'\n')
+            replayed += 1
+
+        if replayed:
+            logger.info(f'Replayed {replayed} spooled batches.')
+        return replayed
+
+    def _submit(self, batch, num_points):
+        self._in_flight.acquire()
+        future = self._executor.submit(self._write, batch, num_points)
+        future.add_done_callback(lambda _: self._in_flight.release())
+
+    def _write(self, batch, num_points):
+        try:
+            self._send(batch)
+        except Exception as e:
+            rejected = is_rejection(e)
+            if rejected:
+                logger.error(f'The database rejected a batch of {num_points} points, quarantining it. {e}')
+                self._spool(batch, self.rejected_dir)
+            else:
+                logger.error(f'Failed to write batch of {num_points} points, spooling it. {e}')
+                self._spool(batch, self.spool_dir)
+            keys = batch_keys(batch)
+            with self._lock:
+                self.failed_batches += 1
+                self.rejected_batches += rejected
+                self.failed_keys.append(keys)
+            return
+
+        with self._lock:
+            self.written_points += num_points
+
+    def _send(self, batch):
+        for attempt in range(1, WRITE_RETRIES + 1):
+            start = time.monotonic()
+            try:
+                self._write_api.write(bucket=BUCKET, record=batch, write_precision=WritePrecision.MS)
+            except Exception as e:
+                if is_rejection(e) or attempt == WRITE_RETRIES:
+                    raise
+                delay = WRITE_RETRY_DELAY_S * 2 ** (attempt - 1) * random.uniform(1, 1.5)
+                logger.warning(f'Write attempt {attempt}/{WRITE_RETRIES} failed, retrying in {delay:.1f}s. {e}')
+                self._adapt(float('inf'))
+                time.sleep(delay)
+                continue
+
+            self._adapt(time.monotonic() - start)
+            return
+
+    def _adapt(self, latency):
+        with self._lock:
+            if latency != float('inf'):
+                self.latencies.append(latency)
+            if latency > WRITE_TARGET_LATENCY_S:
+                self.batch_size = max(MIN_BATCH_SIZE, self.batch_size // 2)
+            elif latency < WRITE_TARGET_LATENCY_S / 2:
+                self.batch_size = min(MAX_BATCH_SIZE, self.batch_size + MIN_BATCH_SIZE)
+
+    def _spool(self, batch, spool_dir):
+        os.makedirs(spool_dir, exist_ok=True)
+        spool_path = os.path.join(spool_dir, f'{time.time_ns()}-{uuid.uuid4().hex}.lp')
+        with open(f'{spool_path}.tmp', 'wb') as f:
+            f.write(batch)
+        os.replace(f'{spool_path}.tmp', spool_path)